@@ -8,6 +8,7 @@ from .config import get_config
 
 from .site import minerclub, db
 from .emailer import mail
+from .membership import member_index
 
 
 def create_app(config='product'):
@@ -25,5 +26,6 @@ def create_app(config='product'):
     app.register_blueprint(minerclub)
     db.init_app(app)
     mail.init_app(app)
+    member_index.init_app(app)
 
     return app
@@ -0,0 +1,804 @@
+import bz2
+import collections
+import datetime
+import gzip
+import json
+import logging
+import lzma
+import os
+import queue
+import re
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from flask import current_app
+
+try:
+    import zstandard
+except ImportError:  # only needed for zst compressed archives
+    zstandard = None
+
+from MinerClub.server_comms import file_manager, fast_copier
+
+logger = logging.getLogger(__name__)
+
+
+class BackupError(Exception):
+    pass
+
+
+def get_now():
+    return datetime.datetime.now().strftime(current_app.config['BACKUP_DIR_FORMAT'])
+
+
+ARCHIVE_SUFFIXES = {'none': '.tar', 'gz': '.tar.gz', 'bz2': '.tar.bz2', 'xz': '.tar.xz', 'zst': '.tar.zst'}
+PARTIAL_SUFFIX = '.partial'
+
+
+def archive_stem(filename):
+    """
+    The name of the backup in the archive filename, or None if it's not an archive.
+    """
+    for suffix in ARCHIVE_SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return None
+
+
+def list_backups(partial=False):
+    """
+    All the backups in `BACKUP_DESTINATION`, both directories and archives, as (date, `os.DirEntry`) pairs, oldest
+    first. Backups that were interrupted before they finished (see `Progress`, and archives still with the '.partial'
+    suffix) are left out, or if partial, are the only ones listed.
+    """
+    backups = []
+    for item in os.scandir(current_app.config['BACKUP_DESTINATION']):
+        if item.is_dir():
+            name, interrupted = item.name, Progress.is_partial(item.path)
+        elif item.name.endswith(PARTIAL_SUFFIX):
+            name, interrupted = archive_stem(item.name[:-len(PARTIAL_SUFFIX)]), True
+        else:
+            name, interrupted = archive_stem(item.name), False
+        if name is None or interrupted != partial:
+            continue
+        try:
+            date = datetime.datetime.strptime(name, current_app.config['BACKUP_DIR_FORMAT'])
+            backups.append((date, item))
+        except ValueError:
+            continue
+
+    backups.sort(key=lambda backup: backup[0])
+    return backups
+
+
+def outdated_backups(keep=None):
+    """
+    The backups beyond the newest keep (defaults to one less than `BACKUP_ROTATION`, to make room for a new one), newest
+    last. Archives left unfinished by an interrupted `archive_backup` can't be resumed, so they're always outdated, and
+    come first.
+    """
+    backups = list_backups()
+    unfinished = [(date, item) for date, item in list_backups(partial=True) if not item.is_dir()]
+
+    rotation = current_app.config['BACKUP_ROTATION'] - 1 # because I'll make a new one!
+    if keep is not None:
+        rotation = keep
+
+    if len(backups) > rotation:
+        index = None if rotation == 0 else -rotation # because :0 is different to :None.
+        return unfinished + backups[:index]
+    else:
+        return unfinished
+
+
+TRASH = '.trash'
+
+
+def trash_dir():
+    return Path(current_app.config['BACKUP_DESTINATION']) / TRASH
+
+
+def trash_backups(backups):
+    """
+    Move backups, as given by `outdated_backups`, into the trash in `BACKUP_DESTINATION`. This is just a rename, so it's
+    instant however big they are, and they no longer count as backups. Deleting them is left to `empty_trash`.
+    """
+    if not backups:
+        return
+
+    trash = trash_dir()
+    trash.mkdir(exist_ok=True)
+    for _, item in backups:
+        target = trash / item.name
+        n = 1
+        while target.exists():  # left over from a previous run
+            target = trash / '{}.{}'.format(item.name, n)
+            n += 1
+        os.rename(item.path, target)
+
+
+def empty_trash(workers=None):
+    """
+    Delete everything in the trash, removing up to `BACKUP_PRUNE_WORKERS` directories at once, then the trash itself.
+    Returns the number of backups deleted.
+    """
+    trash = trash_dir()
+    if not trash.exists():
+        return 0
+
+    trashed = list(os.scandir(trash))
+    # each backup is split into its top level directories (world, world_nether...), so they can go in parallel
+    parts = [part.path for item in trashed if item.is_dir() for part in os.scandir(item.path)]
+    with ThreadPoolExecutor(workers or current_app.config['BACKUP_PRUNE_WORKERS'],
+                            thread_name_prefix='backup-prune') as pool:
+        for _ in pool.map(remove_path, parts):
+            pass
+
+    for item in trashed:
+        remove_path(item.path)
+
+    try:
+        trash.rmdir()
+    except OSError:  # something's been trashed since
+        pass
+    return len(trashed)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def empty_trash_in_background():
+    """
+    Start `empty_trash` in a separate thread, returning the thread.
+    """
+    app = current_app._get_current_object()
+
+    def empty():
+        with app.app_context():
+            try:
+                logger.info("Deleted {} outdated backups".format(empty_trash()))
+            except Exception:
+                logger.exception("Emptying backup trash failed, run prune-backups to try again")
+
+    thread = threading.Thread(target=empty, name='backup-prune')
+    thread.start()
+    return thread
+
+
+class Manifest:
+    """
+    The size and modification time (on the server) of every file in a backup, saved alongside it so the next backup
+    can tell which files have changed since.
+    """
+    FILENAME = '.manifest.json'
+
+    def __init__(self, files=None):
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, snapshot):
+        try:
+            with open(Path(snapshot) / cls.FILENAME) as f:
+                return cls(json.load(f)['files'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, snapshot):
+        path = Path(snapshot) / self.FILENAME
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.files}, f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def add(self, name, size, mtime):
+        self.files[name] = [size, mtime]
+
+    def unchanged(self, name, size, mtime):
+        return self.files.get(name) == [size, mtime]
+
+
+class Progress:
+    """
+    Records each file in a backup as it's completed, in a '.progress' file inside it, so if the backup's interrupted,
+    it can be resumed without fetching those files again. When the backup's finished, a '.complete' file is written,
+    and the progress file removed.
+
+    A backup with a progress file and no '.complete' is partial. Backups from before these existed have neither, and
+    count as complete.
+    """
+    FILENAME = '.progress'
+    COMPLETE = '.complete'
+
+    def __init__(self, snapshot):
+        self.snapshot = Path(snapshot)
+        self.done = self.load()
+        self._lock = threading.Lock()
+        self._file = open(self.snapshot / self.FILENAME, 'a')
+
+    @classmethod
+    def is_partial(cls, snapshot):
+        snapshot = Path(snapshot)
+        return (snapshot / cls.FILENAME).exists() and not (snapshot / cls.COMPLETE).exists()
+
+    def load(self):
+        done = {}
+        try:
+            with open(self.snapshot / self.FILENAME) as f:
+                for line in f:
+                    try:
+                        name, size, mtime = json.loads(line)
+                    except ValueError:  # cut off part way through writing
+                        continue
+                    done[name] = [size, mtime]
+        except FileNotFoundError:
+            pass
+        return done
+
+    def completed(self, name, size, mtime):
+        """
+        Whether the file name was already completed, and hasn't changed on the server since.
+        """
+        local = self.snapshot / name
+        return self.done.get(name) == [size, mtime] and local.is_file() and local.stat().st_size == size
+
+    def add(self, name, size, mtime):
+        with self._lock:
+            self._file.write(json.dumps([name, size, mtime]) + '\n')
+            self._file.flush()
+
+    def finish(self):
+        self.close()
+        (self.snapshot / self.COMPLETE).touch()
+        os.remove(self.snapshot / self.FILENAME)
+
+    def close(self):
+        self._file.close()
+
+
+def latest_manifest(exclude=None):
+    """
+    The newest backup with a manifest, and that manifest, or (None, None) if there isn't one.
+    """
+    for _, item in reversed(list_backups()):
+        if exclude is not None and Path(item.path) == Path(exclude):
+            continue
+        manifest = Manifest.load(item.path)
+        if manifest is not None:
+            return Path(item.path), manifest
+    return None, None
+
+
+class BackupStats:
+
+    def __init__(self):
+        self.transferred = 0
+        self.transferred_bytes = 0
+        self.carried = 0
+        self.carried_bytes = 0
+        self.linked = 0
+        self.resumed = 0
+        self.shrunk = 0
+        self.methods = collections.Counter()  # how files were copied, if the engine says
+
+    def __str__(self):
+        text = "{} files ({:.1f} MB) transferred, {} unchanged files ({:.1f} MB) carried forward ({} hard-linked)" \
+            .format(self.transferred, self.transferred_bytes / 1e6, self.carried, self.carried_bytes / 1e6, self.linked)
+        if self.resumed:
+            text += ", {} already done before being interrupted".format(self.resumed)
+        if self.shrunk:
+            text += ", {} shrank while being archived (padded with zeros)".format(self.shrunk)
+        if self.methods:
+            text += ", copied by {}".format(', '.join('{} ({})'.format(method, n) for method, n in self.methods.items()))
+        return text
+
+
+def carry_forward(previous, local, link):
+    """
+    Copy the unchanged file previous into the new backup at local (with `fast_copier`, so a reflink where possible), or
+    hard-link it if link, so both backups share the same data on disk. Falls back to copying if the link can't be made
+    (e.g. the backups are on different filesystems). Returns whether a link was made.
+    """
+    if os.path.lexists(local):
+        os.unlink(local)  # from an interrupted backup, and may be hard-linked to another, so mustn't be written to
+
+    if link:
+        try:
+            os.link(previous, local)
+            return True
+        except OSError as e:
+            logger.debug("Couldn't link {}, copying instead: {}".format(previous, e))
+    fast_copier.copy(previous, local)
+    return False
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a gitignore-style glob into a regex: `*` and `?` don't match '/', but `**` does.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[{}]'.format(chars.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(regex)
+
+
+class BackupFilter:
+    """
+    Decides which files are left out of backups, from gitignore-style patterns (`BACKUP_EXCLUDE` by default), matched
+    against paths within the backup, which start with the source's name (e.g. 'world/region/r.0.0.mca'):
+
+    * A pattern without a '/' (other than a trailing one) matches a name at any depth, in any source, e.g. 'session.lock'.
+    * Otherwise it's matched from the start of the path, so can pick out one source, e.g. 'world/DIM*/data/raids.dat'.
+    * A trailing '/' only matches directories, e.g. 'logs/'.
+    * A leading '!' includes anything matched, that an earlier pattern excluded, e.g. '!world/datapacks/ours.zip'.
+
+    As with gitignore, the last matching pattern wins, and nothing in an excluded directory can be included again, as
+    it's never looked in.
+    """
+
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = current_app.config['BACKUP_EXCLUDE']
+
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            include = pattern.startswith('!')
+            pattern = pattern.lstrip('!')
+            dirs_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            regex = glob_to_regex(pattern.lstrip('/'))
+            if '/' not in pattern:
+                regex = '(?:.*/)?' + regex
+            self.rules.append((re.compile(regex + r'\Z'), include, dirs_only))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def excluded(self, path, is_dir=False):
+        excluded = False
+        for regex, include, dirs_only in self.rules:
+            if (is_dir or not dirs_only) and regex.match(path):
+                excluded = not include
+        return excluded
+
+
+def remote_files(host, source, backup_filter=None):
+    """
+    Walk source on the server, yielding (path on the server, path within the backup, `os.stat_result`-like) for each
+    file, and (path on the server, path within the backup, None) for each directory.
+
+    Paths within the backup start with the source's own name, as with `copy_dir`. Anything backup_filter excludes is
+    skipped, without walking excluded directories at all.
+    """
+    source = Path(source)
+    if backup_filter and backup_filter.excluded(source.name, is_dir=True):
+        return
+
+    top = None
+    for root, dirs, files in file_manager.walk(host, source.as_posix()):
+        root = Path(root)
+        if top is None:
+            top = root  # engines differ over whether they give absolute paths
+        relative = root.relative_to(top)
+        remote_dir = source / relative
+        local_dir = Path(source.name) / relative
+
+        if backup_filter:
+            # changing dirs in place stops the walk going into them, as with os.walk
+            dirs[:] = [d for d in dirs if not backup_filter.excluded((local_dir / d).as_posix(), is_dir=True)]
+            files = [f for f in files if not backup_filter.excluded((local_dir / f).as_posix())]
+
+        yield remote_dir, local_dir, None
+        for file in files:
+            remote = remote_dir / file
+            attrs = getattr(file, 'attrs', None) or file_manager.stat(host, remote.as_posix())  # see `WalkName`
+            yield remote, local_dir / file, attrs
+
+
+def filter_summary(host, sources, backup_filter):
+    """
+    Walk all of sources, without skipping anything, to find what backup_filter would leave out. Returns the (files,
+    bytes) that would be backed up, and an ordered dict of each path (file or whole directory) that would be skipped, to
+    the (files, bytes) in it.
+    """
+    included = [0, 0]
+    skipped = collections.OrderedDict()
+    excluded_dirs = {}
+
+    for source in sources:
+        for _, name, attrs in remote_files(host, source):
+            # a parent directory being excluded takes precedence, as the walk would never get this far
+            parent = next((p for p in reversed(name.parents) if p.as_posix() in excluded_dirs), None)
+            if parent is None and attrs is None:
+                if backup_filter.excluded(name.as_posix(), is_dir=True):
+                    excluded_dirs[name.as_posix()] = True
+                    skipped[name.as_posix()] = [0, 0]
+                continue
+            if attrs is None:
+                continue
+
+            if parent is not None:
+                totals = skipped[parent.as_posix()]
+            elif backup_filter.excluded(name.as_posix()):
+                totals = skipped.setdefault(name.as_posix(), [0, 0])
+            else:
+                totals = included
+            totals[0] += 1
+            totals[1] += attrs.st_size
+
+    return tuple(included), collections.OrderedDict((path, tuple(totals)) for path, totals in skipped.items())
+
+
+class Transfers:
+    """
+    Downloads files from the server over `BACKUP_CONNECTIONS` connections at once, each worker thread taking files from
+    a shared queue, so the round trips for lots of small files overlap rather than add up.
+
+    Use it as a context manager, `put`ting files to download inside. A download that fails is retried on a fresh
+    connection, up to `BACKUP_RETRIES` times. Leaving waits for every download to finish, then raises `BackupError` if
+    any couldn't be made.
+
+    Files of at least `BACKUP_SEGMENT_THRESHOLD` bytes are fetched in pieces, in parallel, see `segmented_download`. The
+    connections for the pieces count towards the same limit, so however the files are split, no more than `connections`
+    are open at once (plus the one the caller walks the server with). on_complete, if given, is called with the local path and attrs of each file once it's downloaded, from the worker
+    thread that downloaded it.
+    """
+    DONE = None
+
+    def __init__(self, connections=None, retries=None, on_complete=None):
+        c = current_app.config
+        self.on_complete = on_complete
+        self.connections = max(1, connections or c['BACKUP_CONNECTIONS'])
+        self.retries = c['BACKUP_RETRIES'] if retries is None else retries
+        self.failed = []
+        self.methods = collections.Counter()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.connections)
+        self._queue = queue.Queue(self.connections * 16)  # so the walk doesn't get too far ahead of the downloads
+        self._cancelled = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        app = current_app._get_current_object()
+        for i in range(self.connections):
+            thread = threading.Thread(target=self._work, args=(app,), name='backup-transfer-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._cancelled.set()  # don't carry on downloading for a backup that's failed anyway
+        for _ in self._threads:
+            self._queue.put(self.DONE)
+        for thread in self._threads:
+            thread.join()
+
+        if exc_type is None and self.failed:
+            raise BackupError("{} files couldn't be downloaded: {}".format(
+                len(self.failed), ', '.join(remote for remote, _ in self.failed[:10])))
+
+    def put(self, remote, local, attrs=None):
+        """
+        Queue the file remote to be downloaded to local. attrs are the file's `os.stat_result`-like attributes, if known.
+        """
+        self._queue.put((remote, local, attrs))
+
+    def _connect(self):
+        """
+        Check out a connection, once one of the `connections` slots is free.
+        """
+        self._slots.acquire()
+        try:
+            return file_manager.get_host()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _disconnect(self, lease, error=None):
+        try:
+            if error is None:
+                lease.__exit__(None, None, None)
+            else:
+                lease.__exit__(type(error), error, error.__traceback__)  # connection may be broken, so not reused
+        finally:
+            self._slots.release()
+
+    def _work(self, app):
+        with app.app_context():
+            lease = host = None
+            try:
+                while True:
+                    item = self._queue.get()
+                    if item is self.DONE:
+                        break
+                    if self._cancelled.is_set():
+                        continue
+
+                    remote, local, attrs = item
+                    segmented = file_manager.SEGMENTED and attrs is not None and \
+                        attrs.st_size >= current_app.config['BACKUP_SEGMENT_THRESHOLD']
+                    for attempt in range(self.retries + 1):
+                        try:
+                            local.parent.mkdir(parents=True, exist_ok=True)  # in case it's not been made yet
+                            if os.path.lexists(local):
+                                os.unlink(local)  # from an interrupted backup, and may be hard-linked to another
+                            if segmented:
+                                if lease is not None:  # give up this connection's slot to the pieces
+                                    self._disconnect(lease)
+                                    lease = host = None
+                                segmented_download(remote, local, attrs, self._slots)
+                            else:
+                                if lease is None:
+                                    lease = self._connect()
+                                    host = lease.__enter__()
+                                method = file_manager.download(host, remote, local.as_posix())
+                                if method:
+                                    with self._lock:
+                                        self.methods[method] += 1
+
+                            if self.on_complete is not None:
+                                self.on_complete(local, attrs)
+                            break
+                        except Exception as e:
+                            if lease is not None:
+                                self._disconnect(lease, e)
+                                lease = host = None
+
+                            if attempt == self.retries:
+                                logger.error("Downloading {} failed: {}".format(remote, e))
+                                self.failed.append((remote, e))
+                            else:
+                                logger.warning("Downloading {} failed, retrying: {}".format(remote, e))
+                                time.sleep(attempt)
+            finally:
+                if lease is not None:
+                    self._disconnect(lease)
+
+
+def segmented_download(remote, local, attrs, slots=None):
+    """
+    Download the file remote to local in `BACKUP_SEGMENT_SIZE` pieces, over up to `BACKUP_SEGMENTS` connections at
+    once, so one big file isn't limited to the speed of a single stream. Each connection is kept for the whole file,
+    fetching pieces from a shared queue until they're all done.
+
+    slots is a semaphore each connection is held under, so the pieces share a limit with other downloads (see
+    `Transfers`). Without it, the limit is `BACKUP_SEGMENTS`.
+
+    attrs are the file's attributes from when it was listed. If any piece comes back short, or the file's size or
+    modification time on the server are different once it's downloaded, it was changed part way through, and the pieces
+    may not match, so `BackupError` is raised.
+    """
+    c = current_app.config
+    size, segment = attrs.st_size, c['BACKUP_SEGMENT_SIZE']
+    with open(local, 'wb') as f:
+        f.truncate(size)
+
+    app = current_app._get_current_object()
+    if slots is None:
+        slots = threading.BoundedSemaphore(c['BACKUP_SEGMENTS'])
+
+    offsets = queue.SimpleQueue()
+    for offset in range(0, size, segment):
+        offsets.put(offset)
+
+    def fetch():
+        copied = 0
+        with app.app_context(), slots:
+            if offsets.empty():  # the others got through them all while this waited for a slot
+                return copied
+            with file_manager.get_host() as host:
+                while True:
+                    try:
+                        offset = offsets.get_nowait()
+                    except queue.Empty:
+                        return copied
+                    length = min(segment, size - offset)
+                    got = file_manager.download_range(host, remote, local.as_posix(), offset, length)
+                    if got != length:
+                        raise BackupError("Got {} of the {} bytes at {} in {}".format(got, length, offset, remote))
+                    copied += got
+
+    workers = min(c['BACKUP_SEGMENTS'], offsets.qsize())
+    with ThreadPoolExecutor(workers, thread_name_prefix='backup-segment') as pool:
+        copied = sum(pool.map(lambda _: fetch(), range(workers)))
+
+    with slots, file_manager.get_host() as host:
+        now = file_manager.stat(host, remote)
+    if (now.st_size, now.st_mtime) != (size, attrs.st_mtime) or copied != size:
+        raise BackupError("{} changed while it was being downloaded".format(remote))
+
+
+def run_backup(host, sources, destination, mode='incremental'):
+    """
+    Back up sources into destination, using host to walk the server, and `Transfers` to download files.
+
+    In 'full' mode every file is downloaded. In 'incremental' mode, only the files that are new or have changed size or
+    modification time since the last backup with a manifest are downloaded, and the rest are copied over from that
+    backup. Either way, the result is a complete backup, which doesn't depend on any other.
+
+    'snapshot' mode is the same as 'incremental', but unchanged files are hard-linked to the last backup's rather than
+    copied (like `rsync --link-dest`), so each backup only takes up the space of what changed, and deleting one only
+    frees the files no other backup shares. Files in backups must then never be edited in place, as the change would
+    show up in every backup sharing them.
+
+    Progress is recorded as files complete (see `Progress`), so if destination is a partial backup, it's resumed,
+    fetching only the files that weren't finished, or have changed since.
+    """
+    destination = Path(destination)
+    previous, prior = (None, None) if mode == 'full' else latest_manifest(exclude=destination)
+    if previous is None:
+        logger.info("No previous manifest to compare with, backing up everything")
+        prior = Manifest()
+
+    backup_filter = BackupFilter()
+    manifest = Manifest()
+    stats = BackupStats()
+    progress = Progress(destination)
+
+    def downloaded(local, attrs):
+        progress.add(local.relative_to(destination).as_posix(), attrs.st_size, attrs.st_mtime)
+
+    try:
+        with Transfers(on_complete=downloaded) as transfers:
+            for source in sources:
+                for remote, name, attrs in remote_files(host, source, backup_filter):
+                    local = destination / name
+                    if attrs is None:
+                        local.mkdir(parents=True, exist_ok=True)
+                        continue
+
+                    key = name.as_posix()
+                    if progress.completed(key, attrs.st_size, attrs.st_mtime):
+                        stats.resumed += 1
+                    elif prior.unchanged(key, attrs.st_size, attrs.st_mtime) and (previous / name).is_file():
+                        stats.linked += carry_forward(previous / name, local, mode == 'snapshot')
+                        stats.carried += 1
+                        stats.carried_bytes += attrs.st_size
+                        progress.add(key, attrs.st_size, attrs.st_mtime)
+                    else:
+                        transfers.put(remote.as_posix(), local, attrs)
+                        stats.transferred += 1
+                        stats.transferred_bytes += attrs.st_size
+                    manifest.add(key, attrs.st_size, attrs.st_mtime)
+
+        stats.methods = transfers.methods
+        manifest.save(destination)
+        progress.finish()
+    finally:
+        progress.close()
+    return stats
+
+
+def open_compressed(raw, codec, level):
+    """
+    Wrap the binary file raw so what's written to it is compressed with codec, one of `ARCHIVE_SUFFIXES`.
+    """
+    if codec == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    if codec == 'bz2':
+        return bz2.BZ2File(raw, 'wb', compresslevel=level)
+    if codec == 'xz':
+        return lzma.LZMAFile(raw, 'wb', preset=level)
+    if codec == 'zst':
+        if zstandard is None:
+            raise BackupError("The zstandard package needs to be installed for zst compression")
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+    return raw
+
+
+class SizedReader:
+    """
+    Reads exactly size bytes from the file object f, as promised by a tar header written before any of it's read. If f
+    ends early, because the file shrank since it was listed, the rest is made up with zeros (as GNU tar does), so the
+    archive can carry on, and `short` is set.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+        self.short = False
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        chunks = []
+        wanted = n
+        while wanted and not self.short:
+            data = self.f.read(wanted)
+            if not data:
+                self.short = True
+                break
+            chunks.append(data)
+            wanted -= len(data)
+        chunks.append(bytes(wanted))
+        self.remaining -= n
+        return b''.join(chunks)
+
+
+def archive_backup(host, sources, destination):
+    """
+    Back up sources into a single tar archive at destination (plus the suffix for `BACKUP_COMPRESSION`), compressed
+    with `BACKUP_COMPRESSION_LEVEL`.
+
+    Each file is streamed from the server straight into the archive, a buffer at a time, so nothing is staged on disk.
+    As each file's size goes in the archive before its contents, one that's changed since it was listed is cut off at
+    (or padded out to, see `SizedReader`) its listed size. The archive is written with a '.partial' suffix, which is only
+    removed once it's complete. Returns the path to the archive, and its `BackupStats`.
+    """
+    c = current_app.config
+    codec = c['BACKUP_COMPRESSION']
+    path = Path(str(destination) + ARCHIVE_SUFFIXES[codec])
+    partial = path.with_name(path.name + PARTIAL_SUFFIX)
+
+    backup_filter = BackupFilter()
+    stats = BackupStats()
+    try:
+        with open(partial, 'wb') as raw:
+            compressed = open_compressed(raw, codec, c['BACKUP_COMPRESSION_LEVEL'])
+            try:
+                with tarfile.open(fileobj=compressed, mode='w|') as tar:
+                    for source in sources:
+                        for remote, name, attrs in remote_files(host, source, backup_filter):
+                            info = tarfile.TarInfo(name.as_posix())
+                            if attrs is None:
+                                info.type = tarfile.DIRTYPE
+                                info.mode = 0o755
+                                info.mtime = int(time.time())
+                                tar.addfile(info)
+                                continue
+
+                            info.size = attrs.st_size
+                            info.mode = 0o644
+                            info.mtime = int(attrs.st_mtime)
+                            with file_manager.open_read(host, remote.as_posix()) as f:
+                                reader = SizedReader(f, attrs.st_size)
+                                tar.addfile(info, reader)
+                            if reader.short:
+                                logger.warning("{} shrank while being archived, padded it out to its listed size of {} "
+                                               "bytes".format(remote, attrs.st_size))
+                                stats.shrunk += 1
+                            stats.transferred += 1
+                            stats.transferred_bytes += attrs.st_size
+            finally:
+                if compressed is not raw:
+                    compressed.close()
+    except BaseException:
+        if partial.exists():
+            partial.unlink()
+        raise
+
+    os.replace(partial, path)
+    return path, stats
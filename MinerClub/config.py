@@ -1,3 +1,4 @@
+import re
 import os
 import pathlib
 import tempfile
@@ -24,13 +25,40 @@ class Base:
     QUOTA: int = 4
     CODE_SALT: bytes = Required
     USE_MEMBERS_LIST: bool = True
+    MEMBERS_FILE: str = 'members.csv'
+    MEMBERS_INDEX_FILE: str = ''
     EMAIL_TEMPLATE: str = '{}'
     ADMIN_NAME: str = ''
     ADMIN_EMAIL: str = ''
     DISCORD_URL: str = ''
 
+    # Mojang API setup
+    MOJANG_API_URL: str = 'https://api.mojang.com'
+    MOJANG_SESSION_URL: str = 'https://sessionserver.mojang.com'
+    MOJANG_CONNECT_TIMEOUT: float = 3.05
+    MOJANG_READ_TIMEOUT: float = 5
+    MOJANG_RETRIES: int = 2
+    MOJANG_POOL_SIZE: int = 10
+    MOJANG_BREAKER_THRESHOLD: int = 5
+    MOJANG_BREAKER_RESET: int = 30
+    MOJANG_BATCH_SIZE: int = 10
+    MOJANG_BATCH_INTERVAL: float = 1
+    MOJANG_CACHE_SIZE: int = 4096
+    MOJANG_CACHE_TTL: int = 24 * 60 * 60
+    MOJANG_NEGATIVE_CACHE_TTL: int = 5 * 60
+    MOJANG_CACHE_FILE: str = ''
+
     # File setup
     FILE_ENGINE: str = 'SFTP'
+    WHITELIST_SYNC_DELAY: float = 10
+    WHITELIST_SYNC_VERIFY: str = 'stat'
+    WHITELIST_SYNC_STATE: str = 'whitelist_sync.json'
+    FILE_POOL_SIZE: int = 2
+    FILE_POOL_MAX_IDLE: int = 300
+    FILE_POOL_HEALTH_CHECK: int = 10
+    FILE_POOL_KEEPALIVE: int = 30
+    SYNC_TARGETS: list = []
+    SYNC_TIMEOUT: float = 60
 
     FTP_WHITELIST_PATH: str = 'whitelist.json'
     FTP_SERVER_ADDRESS: str = Required
@@ -54,11 +82,27 @@ class Base:
     LOCAL_SERVER_DIR: str = Required
     LOCAL_WHITELIST_PATH: str = 'whitelist.json'
 
+    RCON_ENABLED: bool = False
+    RCON_ADDRESS: str = '127.0.0.1'
+    RCON_PORT: int = 25575
+    RCON_PASSWORD: str = ''
+    RCON_TIMEOUT: float = 5
+
     # Backup setup
     BACKUP_SOURCES: list = ['world', 'world_the_end', 'world_nether']
     BACKUP_DESTINATION: str = 'backups'
     BACKUP_DIR_FORMAT: str = '%y-%m-%d_(%Hh%Mm)'
     BACKUP_ROTATION: int = 3
+    BACKUP_MODE: str = 'full'
+    BACKUP_CONNECTIONS: int = 4
+    BACKUP_RETRIES: int = 2
+    BACKUP_SEGMENT_THRESHOLD: int = 32 * 1024 ** 2
+    BACKUP_SEGMENT_SIZE: int = 8 * 1024 ** 2
+    BACKUP_SEGMENTS: int = 4
+    BACKUP_PRUNE_WORKERS: int = 4
+    BACKUP_EXCLUDE: list = []
+    BACKUP_COMPRESSION: str = 'gz'
+    BACKUP_COMPRESSION_LEVEL: int = 6
 
     # Mail setup
     MAIL_SERVER: str = Required
@@ -67,6 +111,13 @@ class Base:
     MAIL_USERNAME: str = Required
     MAIL_SENDER: tuple = Required
     MAIL_PASSWORD: str = Required
+    MAIL_BATCH_SIZE: int = 20
+    MAIL_MAX_ATTEMPTS: int = 5
+    MAIL_RETRY_DELAY: int = 60
+    MAIL_CLAIM_TIMEOUT: int = 600
+    MAIL_POOL_SIZE: int = 2
+    MAIL_POOL_IDLE_TIMEOUT: int = 120
+    MAIL_POOL_HEALTH_CHECK: int = 10
 
     # Database setup
     DATABASE_FILE: str = 'database.db'
@@ -74,16 +125,54 @@ class Base:
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
 
 
-def from_env(key, post=lambda v: v):
+ENGINE_SETTINGS = {
+    'FTP': {'WHITELIST_PATH': str, 'SERVER_ADDRESS': str, 'SERVER_USERNAME': str, 'SERVER_PASSWORD': str,
+            'SERVER_PORT': int},
+    'FTPS': {'WHITELIST_PATH': str, 'SERVER_ADDRESS': str, 'SERVER_USERNAME': str, 'SERVER_PASSWORD': str,
+             'SERVER_PORT': int},
+    'SFTP': {'WHITELIST_PATH': str, 'SERVER_ADDRESS': str, 'SERVER_USERNAME': str, 'SERVER_PASSWORD': str,
+             'SERVER_PORT': int, 'HOSTKEY_CHECK': to_bool},
+    'LOCAL': {'SERVER_DIR': str, 'WHITELIST_PATH': str},
+}
+
+
+def from_env(key, post=lambda v: v, base_key=None):
     try:
         return post(os.environ[key])
     except KeyError:
-        default = getattr(Base, key)
+        default = getattr(Base, base_key or key)
         if default is Required:
             raise ValueError(f"Required config value {key} not set")
         return default
 
 
+def target_config(target, main):
+    """
+    Settings for an extra whitelist sync target. These are the same as for the main server, but prefixed with the
+    target's name, e.g. `CREATIVE_FILE_ENGINE`, `CREATIVE_SFTP_SERVER_ADDRESS`, `CREATIVE_SYNC_TIMEOUT`...
+
+    Any that aren't set fall back to the main server's setting, as given by the `main` config.
+    """
+    prefix = target + '_'
+
+    def setting(key, post=lambda v: v):
+        try:
+            return post(os.environ[prefix + key])
+        except KeyError:
+            default = getattr(main, key)
+            if default is Required:
+                raise ValueError(f"Required config value {prefix + key} not set")
+            return default
+
+    engine = setting('FILE_ENGINE')
+    config = {prefix + 'FILE_ENGINE': engine,
+              prefix + 'SYNC_TIMEOUT': setting('SYNC_TIMEOUT', float)}
+    for name, post in ENGINE_SETTINGS[engine].items():
+        key = '{}_{}'.format(engine, name)
+        config[prefix + key] = setting(key, post)
+    return config
+
+
 def get_config(config):
     if config == 'product':
         class ProductConfig(Base):
@@ -97,13 +186,40 @@ def get_config(config):
             QUOTA = from_env('QUOTA', post=int)
             CODE_SALT = from_env('CODE_SALT', lambda v: v.encode())
             USE_MEMBERS_LIST = from_env('USE_MEMBERS_LIST', to_bool)
+            MEMBERS_FILE = from_env('MEMBERS_FILE')
+            MEMBERS_INDEX_FILE = from_env('MEMBERS_INDEX_FILE')
             EMAIL_TEMPLATE = from_env('EMAIL_TEMPLATE')
             ADMIN_NAME = from_env('ADMIN_NAME')
             ADMIN_EMAIL = from_env('ADMIN_EMAIL')
             DISCORD_URL = from_env('DISCORD_URL')
 
+            # Mojang API setup
+            MOJANG_API_URL = from_env('MOJANG_API_URL')
+            MOJANG_SESSION_URL = from_env('MOJANG_SESSION_URL')
+            MOJANG_CONNECT_TIMEOUT = from_env('MOJANG_CONNECT_TIMEOUT', float)
+            MOJANG_READ_TIMEOUT = from_env('MOJANG_READ_TIMEOUT', float)
+            MOJANG_RETRIES = from_env('MOJANG_RETRIES', int)
+            MOJANG_POOL_SIZE = from_env('MOJANG_POOL_SIZE', int)
+            MOJANG_BREAKER_THRESHOLD = from_env('MOJANG_BREAKER_THRESHOLD', int)
+            MOJANG_BREAKER_RESET = from_env('MOJANG_BREAKER_RESET', int)
+            MOJANG_BATCH_SIZE = from_env('MOJANG_BATCH_SIZE', int)
+            MOJANG_BATCH_INTERVAL = from_env('MOJANG_BATCH_INTERVAL', float)
+            MOJANG_CACHE_SIZE = from_env('MOJANG_CACHE_SIZE', int)
+            MOJANG_CACHE_TTL = from_env('MOJANG_CACHE_TTL', int)
+            MOJANG_NEGATIVE_CACHE_TTL = from_env('MOJANG_NEGATIVE_CACHE_TTL', int)
+            MOJANG_CACHE_FILE = from_env('MOJANG_CACHE_FILE')
+
             # File setup
             FILE_ENGINE = from_env('FILE_ENGINE')
+            WHITELIST_SYNC_DELAY = from_env('WHITELIST_SYNC_DELAY', float)
+            WHITELIST_SYNC_VERIFY = from_env('WHITELIST_SYNC_VERIFY')
+            WHITELIST_SYNC_STATE = from_env('WHITELIST_SYNC_STATE')
+            FILE_POOL_SIZE = from_env('FILE_POOL_SIZE', int)
+            FILE_POOL_MAX_IDLE = from_env('FILE_POOL_MAX_IDLE', int)
+            FILE_POOL_HEALTH_CHECK = from_env('FILE_POOL_HEALTH_CHECK', int)
+            FILE_POOL_KEEPALIVE = from_env('FILE_POOL_KEEPALIVE', int)
+            SYNC_TARGETS = from_env('SYNC_TARGETS', lambda v: [t.upper() for t in re.findall(r'\w+', v)])
+            SYNC_TIMEOUT = from_env('SYNC_TIMEOUT', float)
 
             if FILE_ENGINE == 'FTP':
                 FTP_WHITELIST_PATH = from_env('FTP_WHITELIST_PATH')
@@ -131,11 +247,29 @@ def get_config(config):
                 LOCAL_SERVER_DIR = from_env('LOCAL_SERVER_DIR')
                 LOCAL_WHITELIST_PATH = from_env('LOCAL_WHITELIST_PATH')
 
+            RCON_ENABLED = from_env('RCON_ENABLED', to_bool)
+
+            if RCON_ENABLED:
+                RCON_ADDRESS = from_env('RCON_ADDRESS')
+                RCON_PORT = from_env('RCON_PORT', int)
+                RCON_PASSWORD = from_env('RCON_PASSWORD')
+                RCON_TIMEOUT = from_env('RCON_TIMEOUT', float)
+
             # Backup setup
             BACKUP_SOURCES = from_env('BACKUP_SOURCES', lambda v: v.split(','))
             BACKUP_DESTINATION = from_env('BACKUP_DESTINATION')
             BACKUP_DIR_FORMAT = from_env('BACKUP_DIR_FORMAT')
             BACKUP_ROTATION = from_env('BACKUP_ROTATION', int)
+            BACKUP_MODE = from_env('BACKUP_MODE')
+            BACKUP_CONNECTIONS = from_env('BACKUP_CONNECTIONS', int)
+            BACKUP_RETRIES = from_env('BACKUP_RETRIES', int)
+            BACKUP_SEGMENT_THRESHOLD = from_env('BACKUP_SEGMENT_THRESHOLD', int)
+            BACKUP_SEGMENT_SIZE = from_env('BACKUP_SEGMENT_SIZE', int)
+            BACKUP_SEGMENTS = from_env('BACKUP_SEGMENTS', int)
+            BACKUP_PRUNE_WORKERS = from_env('BACKUP_PRUNE_WORKERS', int)
+            BACKUP_EXCLUDE = from_env('BACKUP_EXCLUDE', lambda v: v.split(','))
+            BACKUP_COMPRESSION = from_env('BACKUP_COMPRESSION')
+            BACKUP_COMPRESSION_LEVEL = from_env('BACKUP_COMPRESSION_LEVEL', int)
 
             # Mail setup
             MAIL_SERVER = from_env('MAIL_SERVER')
@@ -144,10 +278,22 @@ def get_config(config):
             MAIL_USERNAME = from_env('MAIL_USERNAME')
             MAIL_SENDER = (CLUB_NAME, MAIL_SERVER)
             MAIL_PASSWORD = from_env('MAIL_PASSWORD')
+            MAIL_BATCH_SIZE = from_env('MAIL_BATCH_SIZE', int)
+            MAIL_MAX_ATTEMPTS = from_env('MAIL_MAX_ATTEMPTS', int)
+            MAIL_RETRY_DELAY = from_env('MAIL_RETRY_DELAY', int)
+            MAIL_CLAIM_TIMEOUT = from_env('MAIL_CLAIM_TIMEOUT', int)
+            MAIL_POOL_SIZE = from_env('MAIL_POOL_SIZE', int)
+            MAIL_POOL_IDLE_TIMEOUT = from_env('MAIL_POOL_IDLE_TIMEOUT', int)
+            MAIL_POOL_HEALTH_CHECK = from_env('MAIL_POOL_HEALTH_CHECK', int)
 
             # Database setup
             DATABASE_FILE = from_env('DATABASE_FILE')
             SQLALCHEMY_DATABASE_URI = "sqlite:///" + DATABASE_FILE
+
+        for target in ProductConfig.SYNC_TARGETS:
+            for key, value in target_config(target, ProductConfig).items():
+                setattr(ProductConfig, key, value)
+
         return ProductConfig
 
     elif config == 'testing':
@@ -161,6 +307,9 @@ def get_config(config):
             ACCESS_CODE = ""
             CODE_SALT = "Testing Salt".encode()
 
+            WHITELIST_SYNC_DELAY = 0
+            WHITELIST_SYNC_STATE = (pathlib.Path(tempfile.gettempdir()) / "whitelist_sync.json").as_posix()
+
             FTP_SERVER_ADDRESS = '127.0.0.1'
             FTP_SERVER_WHITELIST_PATH = 'basedir/whitelist.json'
             FTP_SERVER_PORT = 21
@@ -183,6 +332,11 @@ def get_config(config):
             LOCAL_WHITELIST_PATH = 'basedir/whitelist.json'
             LOCAL_SERVER_DIR = None
 
+            RCON_ADDRESS = '127.0.0.1'
+            RCON_PORT = 25575
+            RCON_PASSWORD = 'RCON test_password'
+            RCON_TIMEOUT = 2
+
             BACKUP_SOURCES = "basedir,basedir/subdir".split(',')
             BACKUP_DESTINATION = None
             BACKUP_ROTATION = 1
@@ -203,6 +357,7 @@ class Messages:
     WRONG_ACCESS_CODE = "Invalid Access Code."
     WRONG_MEMBER_ID = "Invalid membership ID."
     UNKNOWN_USERNAME = "Invalid Minecraft account username, please check spelling."
+    MOJANG_UNAVAILABLE = "Couldn't reach Mojang to check your username, please try again in a few minutes."
     ALREADY_ACTIVATED = "It seems this membership ID already has an account associated - check your inbox/ junk!"
     ACTIVATE_SUCCESS = ("Activation success! - just sent a message to {email} info on getting access to the server. "
                         "if you can't find it, check your junk!)")
@@ -210,6 +365,7 @@ class Messages:
     WRONG_SPONSOR_CODE = "No sponsor found with that code..."
     OUTTA_GUESTS = "Your sponsor has ran out of guests!"
     ALREADY_WHITELISTED = "This username is already added to the Whitelist."
+    INVALID_EMAIL = "Invalid email address, please check spelling."
     REGISTER_SUCCESS = ("Registration success! - Your name will be added to the whitelist and we just sent an "
                         "email to {email} with info on how to get onto the server "
                         "(if you can't find it, check your junk!)")
@@ -1,27 +1,72 @@
 import hashlib
-
+import datetime
+import json
 
 from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 
-from MinerClub.emailer import make_activation_email, make_register_email, make_registration_alert_email, mail
+from MinerClub.emailer import make_activation_email, make_register_email, make_registration_alert_email, make_email, \
+    transport
 
 db = SQLAlchemy()
 
 
+def dashed_uuid(mj_id):
+    """
+    Mojang gives IDs as 32 hex digits, whitelist.json wants them in canonical 8-4-4-4-12 form.
+    """
+    return '-'.join((mj_id[:8], mj_id[8:12], mj_id[12:16], mj_id[16:20], mj_id[20:]))
+
+
+def header_safe(address):
+    """
+    Check an email address can go in a message header as is, i.e. it can't inject extra headers and needs no encoding.
+    """
+    return bool(address) and address.isascii() and address.isprintable()
+
+
 class Member(db.Model):
     id = db.Column(db.String, primary_key=True)
-    sponsor_code = db.Column(db.String)
+    sponsor_code = db.Column(db.String, unique=True, index=True)
     email = db.Column(db.String)
+    guest_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sponsor_code = self.make_code()
         self.email = self.make_email()
+        self.guest_count = 0
 
     @property
     def quota(self):
-        return current_app.config['QUOTA'] - len(self.users)
+        return current_app.config['QUOTA'] - self.guest_count
+
+    @classmethod
+    def miscounted(cls):
+        """
+        Find members whose `guest_count` doesn't match their number of whitelist entries.
+
+        Returns a list of (member id, guest_count, actual count) tuples.
+        """
+        actual = (db.session.query(Whitelist.member_id, db.func.count().label('n'))
+                  .group_by(Whitelist.member_id)
+                  .subquery())
+        n = db.func.coalesce(actual.c.n, 0)
+        return (db.session.query(cls.id, cls.guest_count, n)
+                .outerjoin(actual, actual.c.member_id == cls.id)
+                .filter(cls.guest_count != n)
+                .all())
+
+    @classmethod
+    def recount_guests(cls):
+        """
+        Reset every `guest_count` from the whitelist, in a single statement.
+        """
+        n = (db.select([db.func.count()])
+             .where(Whitelist.member_id == cls.id)
+             .as_scalar())
+        db.session.execute(cls.__table__.update().values(guest_count=n))
+        db.session.commit()
 
     def make_code(self):
         sha = hashlib.sha256()
@@ -33,8 +78,8 @@ class Member(db.Model):
     def make_email(self):
         return current_app.config['EMAIL_TEMPLATE'].format(self.id)
 
-    def send_activate_email(self):
-        mail.send(make_activation_email(self))
+    def queue_activate_email(self):
+        Outbox.queue(make_activation_email(self))
 
 
 class Whitelist(db.Model):
@@ -42,20 +87,191 @@ class Whitelist(db.Model):
     id = db.Column(db.String, nullable=False)
     email = db.Column(db.String, nullable=False)
 
-    member_id = db.Column(db.Integer, db.ForeignKey('member.id'),
-                          nullable=False)
+    member_id = db.Column(db.String, db.ForeignKey('member.id'),
+                          nullable=False, index=True)
     sponsor = db.relationship('Member',
                               backref=db.backref('users', lazy=True))
 
+    @classmethod
+    def pages(cls, page_size):
+        """
+        Iterate over (username, id) pairs of every entry, page_size at a time, without loading the whole table.
+        """
+        last = None
+        while True:
+            query = db.session.query(cls.username, cls.id).order_by(cls.username)
+            if last is not None:
+                query = query.filter(cls.username > last)
+            page = query.limit(page_size).all()
+            if not page:
+                return
+            yield page
+            last = page[-1].username
+
+    @classmethod
+    def rename_all(cls, renames):
+        """
+        Rename entries in a single statement, given (old username, new username) pairs. Renames that would clash with
+        an existing entry are skipped. Returns the renames that were applied.
+        """
+        taken = {username for username, in
+                 db.session.query(cls.username).filter(cls.username.in_([new for _, new in renames]))}
+        renames = [(old, new) for old, new in renames if new not in taken]
+        if renames:
+            db.session.execute(cls.__table__.update()
+                               .where(cls.username == db.bindparam('old'))
+                               .values(username=db.bindparam('new')),
+                               [{'old': old, 'new': new} for old, new in renames])
+        db.session.commit()
+        return renames
+
+    @classmethod
+    def iter_entries(cls, batch_size=1000):
+        """
+        Iterate over whitelist.json style entries, fetching batch_size rows at a time rather than loading whole objects
+        for the entire table.
+        """
+        for username, mj_id in db.session.query(cls.username, cls.id).yield_per(batch_size):
+            yield {'uuid': dashed_uuid(mj_id), 'name': username}
+
+    @classmethod
+    def iter_json(cls, chunk_size=1000):
+        """
+        Serialise the whitelist as compact JSON, in chunks of up to chunk_size entries, so it can be written out without
+        holding the whole thing in memory.
+        """
+        yield '['
+        separator = ''
+        chunk = []
+        for entry in cls.iter_entries(chunk_size):
+            chunk.append(json.dumps(entry, separators=(',', ':')))
+            if len(chunk) == chunk_size:
+                yield separator + ','.join(chunk)
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield ']'
+
     @classmethod
     def serialise(cls):
-        entries = cls.query.all()
-        return [entry.to_dict() for entry in entries]
+        return list(cls.iter_entries())
 
     def to_dict(self):
-        return {'uuid': "{}{}{}{}{}{}{}{}-{}{}{}{}-{}{}{}{}-{}{}{}{}-{}{}{}{}{}{}{}{}{}{}{}{}".format(*self.id),
+        return {'uuid': dashed_uuid(self.id),
                 'name': self.username}
 
-    def send_register_emails(self):
-        mail.send(make_register_email(self))
-        mail.send(make_registration_alert_email(self))
+    def queue_register_emails(self):
+        Outbox.queue(make_register_email(self))
+        Outbox.queue(make_registration_alert_email(self))
+
+
+@db.event.listens_for(Whitelist, 'after_insert')
+def count_guest(mapper, connection, entry):
+    """
+    Keep `Member.guest_count` up to date within the same transaction as the entry is added.
+
+    As this is an UPDATE, it also locks the sponsor's row until commit, so concurrent registrations against the same
+    sponsor are counted one after the other.
+    """
+    member = Member.__table__
+    connection.execute(member.update()
+                       .where(member.c.id == entry.member_id)
+                       .values(guest_count=member.c.guest_count + 1))
+
+
+@db.event.listens_for(Whitelist, 'after_delete')
+def uncount_guest(mapper, connection, entry):
+    member = Member.__table__
+    connection.execute(member.update()
+                       .where(member.c.id == entry.member_id)
+                       .values(guest_count=member.c.guest_count - 1))
+
+
+class Outbox(db.Model):
+    """
+    Emails waiting to be sent.
+
+    Views add entries within the same transaction as the rows they relate to, the `mail-worker` command then drains
+    them, so requests never wait on the mail server.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_error = db.Column(db.String)
+    claimed_at = db.Column(db.DateTime)
+
+    @classmethod
+    def queue(cls, message):
+        recipient = message.recipients[0]
+        if not header_safe(recipient):
+            raise ValueError("Refusing to queue email to header-unsafe address {!r}".format(recipient))
+        entry = cls(recipient=recipient,
+                    subject=message.subject,
+                    body=message.body)
+        db.session.add(entry)
+        return entry
+
+    @classmethod
+    def unclaimed(cls):
+        """
+        Filter for entries no worker is sending, including ones claimed by a worker that died before finishing.
+        """
+        abandoned = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['MAIL_CLAIM_TIMEOUT'])
+        return db.or_(cls.claimed_at.is_(None), cls.claimed_at < abandoned)
+
+    @classmethod
+    def pending(cls, batch_size):
+        return (cls.query
+                .filter(cls.attempts < current_app.config['MAIL_MAX_ATTEMPTS'],
+                        cls.next_attempt <= datetime.datetime.utcnow(),
+                        cls.unclaimed())
+                .order_by(cls.id)
+                .limit(batch_size)
+                .all())
+
+    def claim(self):
+        """
+        Mark the entry as being sent by this worker. Returns False if another worker claimed it first.
+        """
+        claimed = (Outbox.query
+                   .filter(Outbox.id == self.id, Outbox.unclaimed())
+                   .update({Outbox.claimed_at: datetime.datetime.utcnow()}, synchronize_session=False))
+        db.session.commit()
+        return claimed == 1
+
+    @classmethod
+    def send_pending(cls, batch_size=None):
+        """
+        Send a batch of due emails.
+
+        Each entry is claimed before it's sent, so overlapping workers don't send it twice. Failed sends are retried
+        with exponential backoff until `MAIL_MAX_ATTEMPTS` is reached, after which they are left in the table for
+        inspection. Returns a tuple of (sent, failed) counts.
+        """
+        sent = failed = 0
+        for entry in cls.pending(batch_size or current_app.config['MAIL_BATCH_SIZE']):
+            if not entry.claim():
+                continue
+            try:
+                transport.send(entry.to_message())
+            except Exception as e:  # anything wrong with this one mustn't hold up the rest of the queue
+                entry.attempts += 1
+                entry.last_error = "{}: {}".format(type(e).__name__, e)
+                entry.claimed_at = None
+                delay = current_app.config['MAIL_RETRY_DELAY'] * 2 ** (entry.attempts - 1)
+                entry.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+                current_app.logger.warning("Failed to send email {} to {} (attempt {}): {}".format(
+                    entry.id, entry.recipient, entry.attempts, e))
+                failed += 1
+            else:
+                db.session.delete(entry)
+                sent += 1
+            db.session.commit()  # commit each one, so a crash can't cause re-sends
+        return sent, failed
+
+    def to_message(self):
+        return make_email(self.recipient, self.subject, self.body)
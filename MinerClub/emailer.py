@@ -1,3 +1,8 @@
+import atexit
+import smtplib
+import threading
+import time
+
 from flask import current_app, render_template
 from flask_mail import Message, Mail
 
@@ -6,6 +11,104 @@ from .config import Messages
 mail = Mail()
 
 
+class MailTransport:
+    """
+    Keeps a small pool of authenticated SMTP connections open, so that sending several messages doesn't repeat the
+    connect, STARTTLS and login round trips for each one.
+
+    Connections are dropped once they've been idle for longer than `MAIL_POOL_IDLE_TIMEOUT`, and are checked with a
+    NOOP before reuse if they've been idle for longer than `MAIL_POOL_HEALTH_CHECK`.
+    """
+
+    def __init__(self, mail):
+        self.mail = mail
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        """
+        Send message down a pooled connection, reconnecting once if the server has dropped it.
+        """
+        connection = self._checkout()
+        try:
+            self._send(connection, message)
+        except smtplib.SMTPServerDisconnected:
+            # the dropped connection's closed already, and if reconnecting fails there's nothing to return to the pool
+            self._send(self._connect(), message)
+
+    def _send(self, connection, message):
+        """
+        Send message down connection, then return it to the pool if it's still usable, otherwise close it.
+        """
+        try:
+            connection.send(message)
+        except smtplib.SMTPServerDisconnected:
+            self._close(connection)
+            raise
+        except smtplib.SMTPException:  # e.g. recipient refused, connection still usable
+            self._checkin(connection)
+            raise
+        except OSError:
+            self._close(connection)
+            raise
+        self._checkin(connection)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _connect(self):
+        connection = self.mail.connect()
+        connection.__enter__()  # opens and authenticates the SMTP session
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _alive(self, connection):
+        if connection.host is None:  # sending is suppressed e.g. when testing
+            return True
+        try:
+            return connection.host.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self):
+        state = current_app.extensions['mail']
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+
+            idle_for = time.monotonic() - last_used
+
+            if connection.mail is not state or idle_for > current_app.config['MAIL_POOL_IDLE_TIMEOUT']:
+                self._close(connection)
+            elif idle_for > current_app.config['MAIL_POOL_HEALTH_CHECK'] and not self._alive(connection):
+                self._close(connection)
+            else:
+                return connection
+
+        return self._connect()
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < current_app.config['MAIL_POOL_SIZE']:
+                self._idle.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+
+
+transport = MailTransport(mail)
+atexit.register(transport.close_all)
+
+
 def make_activation_email(member):
     text = render_template('activate_email.txt',
                            member=member)
@@ -1,7 +1,108 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+class MemberIndex:
+    """
+    Index of membership IDs read from the members file (one per line).
+
+    The file is reloaded whenever its modification time changes. The new index is built completely before being swapped
+    in, so lookups never see a half-loaded list. For very large rosters, set `db_path` to keep the index in a SQLite
+    file rather than in memory.
+    """
+
+    def __init__(self, path='members.csv', db_path=None):
+        self.path = path
+        self.db_path = db_path
+        self._members = frozenset()
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.count = 0
+        self.load_time = None
+        self.loaded_at = None
+
+    def init_app(self, app):
+        self.path = app.config['MEMBERS_FILE']
+        self.db_path = app.config['MEMBERS_INDEX_FILE'] or None
+        self._mtime = None
+
+    def _read(self):
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
 
-with open('members.csv') as f:
-    members = f.read().split('\n')
+    def _db_mtime(self):
+        try:
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                return conn.execute("SELECT mtime FROM source").fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def _build_db(self, mtime):
+        if self._db_mtime() == mtime:  # another worker has already done it
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                return conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+        tmp = '{}.{}.tmp'.format(self.db_path, os.getpid())
+        with closing(sqlite3.connect(tmp)) as conn, conn:
+            conn.execute("DROP TABLE IF EXISTS members")
+            conn.execute("DROP TABLE IF EXISTS source")
+            conn.execute("CREATE TABLE members (id TEXT PRIMARY KEY) WITHOUT ROWID")
+            conn.execute("CREATE TABLE source (mtime INTEGER)")
+            conn.executemany("INSERT OR IGNORE INTO members VALUES (?)", ((member,) for member in self._read()))
+            conn.execute("INSERT INTO source VALUES (?)", (mtime,))
+            count = conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+        os.replace(tmp, self.db_path)
+        return count
+
+    def refresh(self):
+        """
+        Reload the index if the members file has changed since it was last loaded.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:  # another thread got there first
+                return
+
+            start = time.perf_counter()
+            if self.db_path:
+                self.count = self._build_db(mtime)
+            else:
+                self._members = frozenset(self._read())
+                self.count = len(self._members)
+            self._mtime = mtime
+            self.load_time = time.perf_counter() - start
+            self.loaded_at = time.time()
+
+        logger.info("Loaded {} members from {} in {:.3f}s".format(self.count, self.path, self.load_time))
+
+    def __contains__(self, member_id):
+        self.refresh()
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                return conn.execute("SELECT 1 FROM members WHERE id = ?", (member_id,)).fetchone() is not None
+        return member_id in self._members
+
+
+member_index = MemberIndex()
 
 
 def is_member(member_id):
@@ -9,18 +110,302 @@ def is_member(member_id):
     Check is in member list
     """
     if member_id:
-        return member_id in members
+        return member_id in member_index
     return False
 
 
+class ProfileCache:
+    """
+    Cache of Mojang username -> ID lookups.
+
+    Entries are held in an in-process LRU bounded by `MOJANG_CACHE_SIZE`. Usernames that don't exist are cached too
+    (as None), but for `MOJANG_NEGATIVE_CACHE_TTL` rather than `MOJANG_CACHE_TTL`. If `MOJANG_CACHE_FILE` is set,
+    entries are also persisted to that SQLite file, so they survive restarts and are shared between workers.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(username):
+        return username.lower()  # Minecraft usernames are case insensitive
+
+    def get(self, username):
+        """
+        Returns a tuple of (hit, mj_id), mj_id being None for a cached unknown username.
+        """
+        key = self.key(username)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                mj_id, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return True, mj_id
+                del self._entries[key]
+
+        entry = self._load(key)
+        if entry is not None and entry[1] > now:
+            self._remember(key, *entry)
+            return True, entry[0]
+        return False, None
+
+    def set(self, username, mj_id):
+        ttl = current_app.config['MOJANG_CACHE_TTL' if mj_id else 'MOJANG_NEGATIVE_CACHE_TTL']
+        key = self.key(username)
+        expires = time.time() + ttl
+        self._remember(key, mj_id, expires)
+        self._store(key, mj_id, expires)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, mj_id, expires):
+        with self._lock:
+            self._entries[key] = (mj_id, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > current_app.config['MOJANG_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+    def _connect(self):
+        conn = sqlite3.connect(current_app.config['MOJANG_CACHE_FILE'])
+        conn.execute("CREATE TABLE IF NOT EXISTS profiles (username TEXT PRIMARY KEY, id TEXT, expires REAL)")
+        return conn
+
+    def _load(self, key):
+        if not current_app.config['MOJANG_CACHE_FILE']:
+            return None
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT id, expires FROM profiles WHERE username = ?", (key,)).fetchone()
+
+    def _store(self, key, mj_id, expires):
+        if not current_app.config['MOJANG_CACHE_FILE']:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM profiles WHERE expires <= ?", (time.time(),))
+            conn.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)", (key, mj_id, expires))
+
+
+profile_cache = ProfileCache()
+
+
+class MojangUnavailable(Exception):
+    pass
+
+
+VALID_USERNAME = re.compile(r'[A-Za-z0-9_]{1,16}')
+
+
+class MojangClient:
+    """
+    Talks to the Mojang API over a pooled `requests.Session`, with strict timeouts and bounded retries on 429/5xx.
+
+    After `MOJANG_BREAKER_THRESHOLD` consecutive failures the circuit opens, and requests fail immediately with
+    `MojangUnavailable` for `MOJANG_BREAKER_RESET` seconds, after which a single trial request is let through.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._next_batch = 0
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                c = current_app.config
+                retries = Retry(total=c['MOJANG_RETRIES'],
+                                backoff_factor=0.5,
+                                status_forcelist=self.RETRY_STATUSES,
+                                allowed_methods=frozenset(['GET', 'POST']),
+                                respect_retry_after_header=False,
+                                raise_on_status=False)
+                adapter = HTTPAdapter(pool_maxsize=c['MOJANG_POOL_SIZE'], max_retries=retries)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    @property
+    def timeout(self):
+        return current_app.config['MOJANG_CONNECT_TIMEOUT'], current_app.config['MOJANG_READ_TIMEOUT']
+
+    def _check_circuit(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < current_app.config['MOJANG_BREAKER_RESET']:
+                raise MojangUnavailable("Mojang API circuit open after {} failures".format(self._failures))
+            self._opened_at = time.monotonic()  # let this one through as a trial, keep failing everyone else
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if self._failures >= current_app.config['MOJANG_BREAKER_THRESHOLD']:
+                    self._opened_at = time.monotonic()
+
+    def request(self, method, url, **kwargs):
+        self._check_circuit()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self._record(False)
+            raise MojangUnavailable("Mojang API request failed: {}".format(e)) from e
+
+        if response.status_code in self.RETRY_STATUSES:
+            self._record(False)
+            raise MojangUnavailable("Mojang API responded with {}".format(response.status_code))
+
+        self._record(True)
+        return response
+
+    def _profiles(self, usernames):
+        """
+        Look up usernames in one request, returning a dict mapping each (in lower case) to its ID, or None if not found.
+
+        Mojang rejects a whole batch with a 400 if it doesn't like any name in it, in which case each is retried on its
+        own, and any it still rejects are left out, as that's no answer either way.
+        """
+        p = self.request('POST', current_app.config['MOJANG_API_URL'] + '/profiles/minecraft', json=usernames)
+        if p.status_code == 400:
+            ids = {}
+            if len(usernames) > 1:
+                for username in usernames:
+                    self._throttle()
+                    ids.update(self._profiles([username]))
+            return ids
+        if p.status_code != 200:  # mustn't be taken to mean none of them exist
+            raise MojangUnavailable("Mojang API responded with {}".format(p.status_code))
+
+        found = {profile['name'].lower(): profile['id'] for profile in p.json()} if p.content else {}
+        return {username.lower(): found.get(username.lower()) for username in usernames}
+
+    def _throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_batch - now
+            self._next_batch = max(now, self._next_batch) + current_app.config['MOJANG_BATCH_INTERVAL']
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_id(self, username):
+        """
+        Returns None if no user with that name found, raises `MojangUnavailable` if the API can't be reached.
+        """
+        if not VALID_USERNAME.fullmatch(username):
+            return None
+        ids = self._profiles([username])
+        if username.lower() not in ids:
+            raise MojangUnavailable("Mojang API rejected username {}".format(username))
+        return ids[username.lower()]
+
+    def get_name(self, mj_id):
+        """
+        Current username of the player with mojang ID mj_id, or None if there isn't one.
+        """
+        self._throttle()
+        p = self.request('GET', current_app.config['MOJANG_SESSION_URL'] + '/session/minecraft/profile/' + mj_id)
+        if p.status_code == 200 and p.content:
+            return p.json()['name']
+        return None
+
+    def get_ids(self, usernames):
+        """
+        Look up many usernames, `MOJANG_BATCH_SIZE` per request, with requests spaced at least `MOJANG_BATCH_INTERVAL`
+        seconds apart (across all threads) to stay within Mojang's rate limit.
+
+        Returns a dict mapping each username to its ID, or None if not found. Usernames Mojang won't give an answer for
+        are left out.
+        """
+        ids = {}
+        valid = []
+        for username in usernames:
+            if VALID_USERNAME.fullmatch(username):
+                valid.append(username)
+            else:
+                ids[username] = None  # can't be anyone's, no need to ask
+
+        batch_size = current_app.config['MOJANG_BATCH_SIZE']
+        for start in range(0, len(valid), batch_size):
+            batch = valid[start:start + batch_size]
+            self._throttle()
+            found = self._profiles(batch)
+            for username in batch:
+                if username.lower() in found:
+                    ids[username] = found[username.lower()]
+        return ids
+
+
+mojang = MojangClient()
+
+
 def get_mj_id(username):
     """
     Check mojang username exists - get mojang ID thingy.
 
     Returns None if no user with that name found.
     """
-    p = requests.post("https://api.mojang.com/profiles/minecraft", data='["{}"]'.format(username))
-    if p.status_code == 200 and p.json():
-        return p.json()[0]['id']
-    else:
-        return None
+    hit, mj_id = profile_cache.get(username)
+    if hit:
+        return mj_id
+
+    mj_id = mojang.get_id(username)  # raises if Mojang having trouble, so this isn't remembered!
+    profile_cache.set(username, mj_id)
+    return mj_id
+
+
+def get_mj_ids(usernames):
+    """
+    Bulk version of `get_mj_id`, returns a dict mapping each username to its mojang ID, or None if not found. Usernames
+    Mojang won't give an answer for are left out, and not remembered.
+    """
+    ids = {}
+    misses = {}
+    for username in usernames:
+        hit, mj_id = profile_cache.get(username)
+        if hit:
+            ids[username] = mj_id
+        else:
+            misses.setdefault(ProfileCache.key(username), username)
+
+    for username, mj_id in mojang.get_ids(misses.values()).items():
+        profile_cache.set(username, mj_id)
+        ids[username] = mj_id
+
+    for username in usernames:  # catch any duplicates that differed only by case
+        first = misses.get(ProfileCache.key(username))
+        if username not in ids and first in ids:
+            ids[username] = ids[first]
+
+    return ids
+
+
+def find_renames(entries):
+    """
+    Given (username, mojang ID) pairs, finds players that have changed their username since.
+
+    Usernames are checked in batches, and only those no longer belonging to the same ID need their current name looking
+    up individually. Returns a list of (old username, new username) pairs.
+    """
+    ids = mojang.get_ids(username for username, _ in entries)
+    renames = []
+    for username, mj_id in entries:
+        if username not in ids:  # Mojang wouldn't say, try again next time
+            continue
+        profile_cache.set(username, ids[username])
+        if ids[username] == mj_id:
+            continue
+        name = mojang.get_name(mj_id)
+        if name is not None and name != username:
+            renames.append((username, name))
+    return renames
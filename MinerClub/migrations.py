@@ -0,0 +1,105 @@
+"""
+Upgrades for database files made by older versions of MinerClub.
+
+Each migration brings the schema up one version, the version of a database file being kept in SQLite's `user_version`
+pragma. Migrations are given a raw sqlite3 connection, and each is run in its own transaction along with the version
+bump, so one that fails part way leaves the database as it was.
+"""
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from MinerClub.database import db, Whitelist
+
+migrations = []
+
+
+def migration(func):
+    migrations.append(func)
+    return func
+
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_version(connection, version):
+    connection.execute("PRAGMA user_version = {:d}".format(version))
+
+
+def columns(connection, table):
+    return {row[1] for row in connection.execute("PRAGMA table_info({})".format(table))}
+
+
+def create_table(connection, table):
+    connection.execute(str(CreateTable(table).compile(db.engine)))
+    for index in table.indexes:
+        connection.execute(str(CreateIndex(index).compile(db.engine)))
+
+
+@migration
+def add_guest_count(connection):
+    if 'guest_count' not in columns(connection, 'member'):
+        connection.execute("ALTER TABLE member ADD COLUMN guest_count INTEGER NOT NULL DEFAULT 0")
+    connection.execute("UPDATE member SET guest_count = "
+                       "(SELECT COUNT(*) FROM whitelist WHERE whitelist.member_id = member.id)")
+
+
+@migration
+def index_sponsors(connection):
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_member_sponsor_code ON member (sponsor_code)")
+
+    # SQLite can't change the type of a column, so whitelist has to be rebuilt to make member_id a string.
+    connection.execute("ALTER TABLE whitelist RENAME TO whitelist_old")
+    create_table(connection, Whitelist.__table__)
+    connection.execute("INSERT INTO whitelist (username, id, email, member_id) "
+                       "SELECT username, id, email, CAST(member_id AS TEXT) FROM whitelist_old ORDER BY rowid")
+    connection.execute("DROP TABLE whitelist_old")
+
+
+@migration
+def add_outbox_claims(connection):
+    outbox = columns(connection, 'outbox')
+    if outbox and 'claimed_at' not in outbox:  # if there's no outbox yet, create_all makes it with the column
+        connection.execute("ALTER TABLE outbox ADD COLUMN claimed_at DATETIME")
+
+
+def stamp():
+    """
+    Mark the database as up to date, e.g. after creating it from scratch.
+    """
+    with db.engine.begin() as connection:
+        set_version(connection, len(migrations))
+
+
+def upgrade():
+    """
+    Apply any migrations the database is missing, and create any new tables. Returns the names of the migrations applied.
+    """
+    if not db.engine.has_table('member'):  # brand new database, nothing to upgrade
+        db.create_all()
+        stamp()
+        return []
+
+    applied = []
+    raw = db.engine.raw_connection()
+    connection = raw.connection
+    isolation_level = connection.isolation_level
+    # otherwise pysqlite commits DDL as it goes, and only begins transactions for INSERTs and the like
+    connection.isolation_level = None
+    try:
+        version = get_version(connection)
+        for number, func in enumerate(migrations[version:], version + 1):
+            connection.execute("BEGIN")
+            try:
+                func(connection)
+                set_version(connection, number)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            applied.append(func.__name__)
+    finally:
+        connection.isolation_level = isolation_level
+        raw.close()
+
+    db.create_all()
+    return applied
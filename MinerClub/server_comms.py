@@ -1,6 +1,16 @@
+import atexit
+import collections
+import errno
+import hashlib
 import json
-import datetime
+import logging
 import os
+import posixpath
+import socket
+import stat
+import struct
+import threading
+import time
 from abc import abstractmethod
 from pathlib import Path
 from io import BytesIO
@@ -8,26 +18,164 @@ import shutil
 
 from ftplib import FTP_TLS, FTP
 from ftputil import FTPHost, session
+from ftputil.error import FTPError
+import paramiko
 import pysftp
 
 from flask import current_app
 
+from MinerClub.membership import VALID_USERNAME
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class PooledHost:
+    """
+    A connection checked out of a `HostPool`.
+
+    Use it as a context manager, the same as the engines' own hosts: entering gives the connection, and exiting returns
+    it to the pool (or closes it if something went wrong). Otherwise it behaves like the connection itself.
+    """
+
+    def __init__(self, pool, host):
+        self.pool = pool
+        self.host = host
+
+    def __enter__(self):
+        return self.host
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.release(self.host, broken=exc_type is not None)
+
+    def __getattr__(self, item):
+        return getattr(self.host, item)
+
+
+class HostPool:
+    """
+    Open connections to a server, kept for reuse so that each sync or backup doesn't pay for a fresh handshake and login.
+
+    Up to `FILE_POOL_SIZE` idle connections are kept. Those idle for longer than `FILE_POOL_MAX_IDLE` seconds are closed,
+    and those idle for longer than `FILE_POOL_HEALTH_CHECK` seconds are checked before reuse, reconnecting if needed.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        c = current_app.config
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                host, last_used = self._idle.pop()
+
+            idle_for = time.monotonic() - last_used
+
+            if idle_for > c['FILE_POOL_MAX_IDLE']:
+                self.engine.close_host(host)
+            elif idle_for > c['FILE_POOL_HEALTH_CHECK'] and not self.engine.is_alive(host):
+                self.engine.close_host(host)
+            else:
+                self.engine.reset_host(host)
+                return PooledHost(self, host)
+
+        return PooledHost(self, self.engine.get_host())
+
+    def release(self, host, broken=False):
+        if not broken:
+            with self._lock:
+                if len(self._idle) < current_app.config['FILE_POOL_SIZE']:
+                    self._idle.append((host, time.monotonic()))
+                    return
+        self.engine.close_host(host)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for host, _ in idle:
+            self.engine.close_host(host)
+
 
 class FileManager():
+    """
+    Gives access to a server's files, through whichever engine that server is configured to use.
+
+    The main server is configured by `FILE_ENGINE` and its settings. Extra whitelist sync targets (`SYNC_TARGETS`) are
+    configured by the same settings, prefixed with the target's name.
+    """
     engines = {}
+    pools = {}
     host = None
+    _pools_lock = threading.Lock()
+    _target_engines = {}
+
+    def __init__(self, target=None):
+        self.target = target
+        self.prefix = target + '_' if target else ''
+
+    @property
+    def name(self):
+        return self.target or 'main'
 
     @property
     def engine_name(self):
-        return current_app.config['FILE_ENGINE']
+        return current_app.config[self.prefix + 'FILE_ENGINE']
 
     @property
     def engine(self):
-        return self.engines[self.engine_name]
+        if not self.prefix:
+            return self.engines[self.engine_name]
+
+        key = (self.prefix, self.engine_name)
+        with self._pools_lock:
+            if key not in self._target_engines:
+                self._target_engines[key] = type(self.engines[self.engine_name])(self.prefix)
+            return self._target_engines[key]
+
+    @property
+    def timeout(self):
+        return current_app.config[self.prefix + 'SYNC_TIMEOUT']
+
+    def targets(self):
+        """
+        All the servers the whitelist should be synced with, this one first.
+        """
+        return [self] + [FileManager(target) for target in current_app.config['SYNC_TARGETS']]
 
     def __getattr__(self, item):
         return getattr(self.engine, item)
 
+    def get_host(self):
+        """
+        Check out a connection to the server from the engine's pool, see `HostPool`. If `FILE_POOL_SIZE` is 0, a new
+        connection is made each time instead.
+        """
+        engine = self.engine
+        if not current_app.config['FILE_POOL_SIZE']:
+            return engine.get_host()
+
+        with self._pools_lock:
+            pool = self.pools.setdefault(engine.location, HostPool(engine))
+        return pool.checkout()
+
+    def close_all(self):
+        """
+        Close all pooled connections.
+        """
+        with self._pools_lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.close_all()
+
     @classmethod
     def add_engine(cls, name):
         def wraps(new_class):
@@ -38,28 +186,121 @@ class FileManager():
         return wraps
 
 
+class WalkName(str):
+    """
+    A file or directory name from an engine's `walk`, with the attributes (`st_size`, `st_mtime`...) it was listed with,
+    so they needn't be fetched again.
+    """
+
+    def __new__(cls, name, attrs):
+        self = super().__new__(cls, name)
+        self.attrs = attrs
+        return self
+
+
+def copy_range(source, destination, length, buffer_size=1024 ** 2):
+    """
+    Copy length bytes from the file object source to destination, a buffer at a time. Returns the number copied.
+    """
+    copied = 0
+    while copied < length:
+        chunk = source.read(min(buffer_size, length - copied))
+        if not chunk:
+            raise EOFError("File ended {} bytes early".format(length - copied))
+        destination.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+class WindowedReader:
+    """
+    Reads the SFTP file f from start to end, requesting window bytes at a time with `readv`. The requests within each
+    window are sent at once, so reads don't wait on a round trip each, but no more than window bytes are buffered
+    however big the file is.
+
+    Use it as a context manager, which closes f on exit.
+    """
+
+    def __init__(self, f, window, step=1024 ** 2):
+        self.f = f
+        self.window = window
+        self.step = step
+        self.size = f.stat().st_size
+        self._offset = 0
+        self._chunks = iter(())
+        self._buffer = memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        parts = []
+        while size > 0:  # tarfile expects reads to be short only at the end
+            if not self._buffer:
+                self._buffer = memoryview(self._next_chunk())
+                if not self._buffer:
+                    break
+            part, self._buffer = self._buffer[:size], self._buffer[size:]
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def _next_chunk(self):
+        for data in self._chunks:
+            return data
+        if self._offset >= self.size:
+            return b''
+        end = min(self._offset + self.window, self.size)
+        self._chunks = iter(self.f.readv([(start, min(self.step, end - start))
+                                          for start in range(self._offset, end, self.step)]))
+        self._offset = end
+        return next(self._chunks)
+
+
 class AbstractFileEngine:
     ENGINE = None
+    SEGMENTED = False  # whether download_range is worth using to fetch big files in parallel
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
+    def setting(self, name):
+        return current_app.config['{}{}_{}'.format(self.prefix, self.ENGINE, name)]
 
     @property
     def address(self):
-        return current_app.config['{}_SERVER_ADDRESS'.format(self.ENGINE)]
+        return self.setting('SERVER_ADDRESS')
 
     @property
     def port(self):
-        return current_app.config['{}_SERVER_PORT'.format(self.ENGINE)]
+        return self.setting('SERVER_PORT')
 
     @property
     def username(self):
-        return current_app.config['{}_SERVER_USERNAME'.format(self.ENGINE)]
+        return self.setting('SERVER_USERNAME')
 
     @property
     def password(self):
-        return current_app.config['{}_SERVER_PASSWORD'.format(self.ENGINE)]
+        return self.setting('SERVER_PASSWORD')
 
     @property
     def whitelist(self):
-        return current_app.config['{}_WHITELIST_PATH'.format(self.ENGINE)]
+        return self.setting('WHITELIST_PATH')
+
+    @property
+    def location(self):
+        """
+        Identifies the whitelist file this engine writes to.
+        """
+        return '{}://{}@{}:{}/{}'.format(self.ENGINE, self.username, self.address, self.port, self.whitelist)
 
     @abstractmethod
     def get_host(self):
@@ -72,6 +313,24 @@ class AbstractFileEngine:
         """
         pass
 
+    def close_host(self, host):
+        try:
+            host.close()
+        except Exception:  # most likely already dead
+            pass
+
+    def is_alive(self, host):
+        """
+        Check host's connection is still usable.
+        """
+        return True
+
+    def reset_host(self, host):
+        """
+        Clear out any state of host that shouldn't carry over when it's reused from the pool.
+        """
+        pass
+
     @abstractmethod
     def write_text(self, host, path, text):
         """
@@ -79,9 +338,36 @@ class AbstractFileEngine:
         """
         pass
 
+    @abstractmethod
+    def write_chunks(self, host, path, chunks):
+        """
+        Write text to path on the filesystem of the server, streamed from an iterable of chunks.
+        """
+        pass
+
     def copy_dir(self, host, source, destination):
         raise NotImplementedError("copy_dir needs to be implemented with {} for backups")
 
+    def download(self, host, source, destination):
+        """
+        Copy the file source on the server to the local path destination. May return a description of how it was
+        copied.
+        """
+        raise NotImplementedError("download needs to be implemented with {} for backups")
+
+    def download_range(self, host, source, destination, offset, length):
+        """
+        Copy length bytes, starting at offset, of the file source on the server into the same place in the local file
+        destination, which must already exist. Returns the number of bytes copied.
+        """
+        raise NotImplementedError("download_range needs to be implemented with {} for segmented downloads")
+
+    def open_read(self, host, path):
+        """
+        Open the file path on the server for reading, as a binary file object.
+        """
+        raise NotImplementedError("open_read needs to be implemented with {} for backups")
+
     @abstractmethod
     def listdir(self, host, path):
         raise NotImplementedError("listdir needs to be implemented with {} for automated testing")
@@ -94,22 +380,44 @@ class AbstractFileEngine:
     def read_text(self, host, path):
         raise NotImplementedError("listdir needs to be implemented with {} for automated testing")
 
+    @abstractmethod
+    def stat(self, host, path):
+        """
+        Get an `os.stat_result`-like object for path, with at least `st_size` and `st_mtime`.
+        """
+        pass
+
 
 @FileManager.add_engine('FTP')
 class FTPFileEngine(AbstractFileEngine):
+    SEGMENTED = True
 
     def get_host(self):
-        c = current_app.config
-        my_session_factory = session.session_factory(base_class=FTP, port=c['FTP_SERVER_PORT'])
-        return FTPHost(c['FTP_SERVER_ADDRESS'],
-                       c['FTP_SERVER_USERNAME'],
-                       c['FTP_SERVER_PASSWORD'],
+        my_session_factory = session.session_factory(base_class=FTP, port=self.port)
+        return FTPHost(self.address,
+                       self.username,
+                       self.password,
                        session_factory=my_session_factory)
 
+    def is_alive(self, host):
+        try:
+            host.keep_alive()
+            return True
+        except (OSError, EOFError, FTPError):
+            return False
+
+    def reset_host(self, host):
+        host.stat_cache.clear()  # files may have been changed by others since
+
     def write_text(self, host, path, text):
         with host.open(path, 'w') as f:
             f.write(text)
 
+    def write_chunks(self, host, path, chunks):
+        with host.open(path, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
     def read_text(self, host, path):
         with host.open(path) as f:
             return f.read()
@@ -117,9 +425,23 @@ class FTPFileEngine(AbstractFileEngine):
     def listdir(self, host, path):
         return host.listdir(path)
 
+    def stat(self, host, path):
+        return host.stat(path)
+
     def walk(self, host, path):
         return host.walk(path)
 
+    def download(self, host, source, destination):
+        host.download(source, destination)
+
+    def download_range(self, host, source, destination, offset, length):
+        with host.open(source, 'rb', rest=offset) as remote, open(destination, 'r+b') as local:
+            local.seek(offset)
+            return copy_range(remote, local, length)  # closing early aborts the rest of the transfer
+
+    def open_read(self, host, path):
+        return host.open(path, 'rb')
+
     def copy_dir(self, host, source, destination):
         from_ = Path(source)
         to = Path(destination)
@@ -141,34 +463,49 @@ class FTPFileEngine(AbstractFileEngine):
 class FTPSFileEngine(FTPFileEngine):
 
     def get_host(self):
-        c = current_app.config
         my_session_factory = session.session_factory(base_class=FTP_TLS,
                                                      use_passive_mode=True,
-                                                     port=c['FTPS_SERVER_PORT'],
+                                                     port=self.port,
                                                      encrypt_data_channel=True)
-        return FTPHost(c['FTPS_SERVER_ADDRESS'],
-                       c['FTPS_SERVER_USERNAME'],
-                       c['FTPS_SERVER_PASSWORD'],
+        return FTPHost(self.address,
+                       self.username,
+                       self.password,
                        session_factory=my_session_factory)
 
 
 @FileManager.add_engine('SFTP')
 class SFTPFileManager(AbstractFileEngine):
+    SEGMENTED = True
+    READ_WINDOW = 8 * 1024 ** 2  # most open_read buffers at once
 
     def get_host(self):
-        c = current_app.config
         cnopts = pysftp.CnOpts()
-        if not current_app.config['SFTP_HOSTKEY_CHECK']:
+        if not self.setting('HOSTKEY_CHECK'):
             cnopts.hostkeys = None
-        return pysftp.Connection(host=c['SFTP_SERVER_ADDRESS'],
-                                 username=c['SFTP_SERVER_USERNAME'],
-                                 password=c['SFTP_SERVER_PASSWORD'],
-                                 port=c['SFTP_SERVER_PORT'],
+        host = pysftp.Connection(host=self.address,
+                                 username=self.username,
+                                 password=self.password,
+                                 port=self.port,
                                  cnopts=cnopts)
+        host.sftp_client.get_channel().get_transport().set_keepalive(current_app.config['FILE_POOL_KEEPALIVE'])
+        return host
+
+    def is_alive(self, host):
+        try:
+            host.sftp_client.normalize('.')
+            return True
+        except (OSError, EOFError, paramiko.SSHException):
+            return False
 
     def write_text(self, host, path, text):
         host.putfo(BytesIO(text.encode()), path)
 
+    def write_chunks(self, host, path, chunks):
+        with host.open(path, 'wb') as f:
+            f.set_pipelined(True)  # don't wait for each write to be acknowledged
+            for chunk in chunks:
+                f.write(chunk.encode())
+
     def read_text(self, host, path):
         buffer = BytesIO()
         host.getfo(path, buffer)
@@ -177,31 +514,30 @@ class SFTPFileManager(AbstractFileEngine):
     def listdir(self, host, path):
         return host.listdir(path)
 
-    def walk(self, host, path):
-        files = []
-        dirs = [Path(path)]
-        host.walktree(path,
-                      fcallback=lambda p: files.append(Path(p)),
-                      dcallback=lambda d: dirs.append(Path(d)),
-                      ucallback=lambda u: u)
-
-        tree = {}
-
-        dirs.sort(key=lambda d: len(d.parts))
-
-        for folder in dirs:
-            tree[folder] = [[], []]
-
-        dirs.pop(0)
-
-        for folder in dirs:
-            tree[folder.parent][0].append(folder.name)
+    def stat(self, host, path):
+        return host.stat(path)
 
-        for file in files:
-            tree[file.parent][1].append(file.name)
+    def walk(self, host, path):
+        """
+        Walk path top-down like `os.walk`, listing each directory in one round trip with `listdir_attr`, and yielding it
+        straight away, so the rest of the tree needn't be listed before its files can be fetched. As with `os.walk`,
+        removing names from dirs stops them being walked.
 
-        for root, (folders, files) in tree.items():
-            yield root, folders, files
+        Names are `WalkName`s, which carry the `SFTPAttributes` (size, mtime...) they were listed with. Anything that's
+        not a regular file or directory (e.g. a symlink) is left out.
+        """
+        pending = [path]
+        while pending:
+            root = pending.pop()
+            dirs, files = [], []
+            for attrs in host.listdir_attr(root):
+                if stat.S_ISDIR(attrs.st_mode):
+                    dirs.append(WalkName(attrs.filename, attrs))
+                elif stat.S_ISREG(attrs.st_mode):
+                    files.append(WalkName(attrs.filename, attrs))
+
+            yield root, dirs, files
+            pending.extend(posixpath.join(root, d) for d in reversed(dirs))
 
     def copy_dir(self, host, source, destination):
 
@@ -220,29 +556,149 @@ class SFTPFileManager(AbstractFileEngine):
                 destination = dest_dir / file
                 host.get(source.as_posix(), destination.as_posix())
 
+    def download(self, host, source, destination):
+        host.get(source, destination, preserve_mtime=True)
+
+    def download_range(self, host, source, destination, offset, length):
+        step = 1024 ** 2
+        chunks = [(start, min(step, offset + length - start)) for start in range(offset, offset + length, step)]
+        copied = 0
+        with host.open(source, 'rb') as remote, open(destination, 'r+b') as local:
+            local.seek(offset)
+            for data in remote.readv(chunks):  # requests for the whole range are sent at once, rather than one by one
+                copied += local.write(data)
+        return copied
+
+    def open_read(self, host, path):
+        return WindowedReader(host.open(path, 'rb'), self.READ_WINDOW)
+
+
+class FastCopier:
+    """
+    Copies local files the cheapest way the destination's filesystem allows, trying in turn:
+
+    * 'reflink' - a copy-on-write clone (`FICLONE`, on btrfs, XFS...), which shares the data until either copy changes.
+    * 'copy_file_range' - the kernel copies the data, without it passing through Python (Linux, Python 3.8+).
+    * 'sendfile' - much the same, for older kernels and Pythons.
+    * 'copy' - a plain read and write.
+
+    Strategies that turn out not to be supported are remembered per pair of source and destination filesystems, so
+    aren't tried again. EXDEV (a cross-filesystem copy being refused) only moves on to the next strategy for that copy,
+    without being remembered.
+    """
+    STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'copy')
+    UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY}
+    FICLONE = 0x40049409  # from linux/fs.h
+
+    def __init__(self):
+        self._unsupported = collections.defaultdict(set)
+
+    def copy(self, source, destination):
+        """
+        Copy source to destination, along with its modification time and permissions, as `shutil.copy2` does. Returns
+        the strategy used.
+        """
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            unsupported = self._unsupported[os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev]
+            size = os.fstat(src.fileno()).st_size
+            for strategy in self.STRATEGIES:
+                if strategy in unsupported:
+                    continue
+                try:
+                    getattr(self, '_' + strategy)(src, dst, size)
+                    break
+                except OSError as e:
+                    if e.errno not in self.UNSUPPORTED or strategy == 'copy':
+                        raise
+                    if e.errno != errno.EXDEV:
+                        unsupported.add(strategy)
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+
+        shutil.copystat(source, destination)
+        return strategy
+
+    def _reflink(self, src, dst, size):
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, "reflinks not supported")
+        fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+
+    def _copy_file_range(self, src, dst, size):
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, "copy_file_range not supported")
+        while size > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), size)
+            if not copied:
+                break
+            size -= copied
+
+    def _sendfile(self, src, dst, size):
+        if not hasattr(os, 'sendfile'):
+            raise OSError(errno.ENOSYS, "sendfile not supported")
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+
+    def _copy(self, src, dst, size):
+        shutil.copyfileobj(src, dst, 1024 ** 2)
+
+
+fast_copier = FastCopier()
+
 
 @FileManager.add_engine('LOCAL')
 class LocalFileEngine(AbstractFileEngine):
 
     @property
     def home(self):
-        return Path(current_app.config['LOCAL_SERVER_DIR'])
+        return Path(self.setting('SERVER_DIR'))
+
+    @property
+    def location(self):
+        return '{}://{}'.format(self.ENGINE, (self.home / self.whitelist).as_posix())
 
     def get_host(self):
         return self
 
+    def close_host(self, host):
+        pass
+
     def write_text(self, host, path, text):
         (self.home / path).write_text(text)
 
+    def write_chunks(self, host, path, chunks):
+        with open(self.home / path, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
     def copy_dir(self, host, source, destination):
         source = self.home / source
         # needed as shutil.copytree copies source contents, not top level folder!
         destination = destination / source.parts[-1]
-        shutil.copytree(source.as_posix(), destination.as_posix())
+        shutil.copytree(source.as_posix(), destination.as_posix(), copy_function=fast_copier.copy)
+
+    def download(self, host, source, destination):
+        return fast_copier.copy(self.home / source, destination)
+
+    def download_range(self, host, source, destination, offset, length):
+        with open(self.home / source, 'rb') as remote, open(destination, 'r+b') as local:
+            remote.seek(offset)
+            local.seek(offset)
+            return copy_range(remote, local, length)
+
+    def open_read(self, host, path):
+        return open(self.home / path, 'rb')
 
     def listdir(self, host, path):
         return os.listdir(self.home / path)
 
+    def stat(self, host, path):
+        return os.stat(self.home / path)
+
     def walk(self, host, path):
         return os.walk(self.home / path)
 
@@ -257,35 +713,418 @@ class LocalFileEngine(AbstractFileEngine):
 
 
 file_manager = FileManager()
+atexit.register(file_manager.close_all)
+
 
+class SyncState:
+    """
+    Remembers the digest and size of the whitelist last uploaded to each location, in the `WHITELIST_SYNC_STATE` file.
+    """
 
-def update_whitelist(whitelist):
-    data = whitelist.serialise()
-    with file_manager.get_host() as host:
-        file_manager.write_text(host, file_manager.whitelist, json.dumps(data, indent=4))
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return Path(current_app.config['WHITELIST_SYNC_STATE'])
+
+    def _load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
 
+    def get(self, location):
+        with self._lock:
+            return self._load().get(location)
 
-def get_now():
-    return datetime.datetime.now().strftime(current_app.config['BACKUP_DIR_FORMAT'])
+    def set(self, location, digest, size):
+        with self._lock:
+            state = self._load()
+            state[location] = {'digest': digest, 'size': size}
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_text(json.dumps(state))
+            os.replace(tmp.as_posix(), self.path.as_posix())
 
 
-def outdated_backups():
-    backups = []
-    for item in os.scandir(current_app.config['BACKUP_DESTINATION']):
-        if not item.is_dir():
-            continue
+sync_state = SyncState()
+
+UNCHANGED = 'unchanged'
+UPLOADED = 'uploaded'
+DRIFTED = 'drift detected'
+
+
+class Measured:
+    """
+    Wraps an iterable of text chunks, keeping a running sha256 digest and size (in bytes) of what's passed through.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            data = chunk.encode()
+            self.sha.update(data)
+            self.size += len(data)
+            yield chunk
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def measure(chunks):
+    """
+    Get the sha256 digest and size of text chunks.
+    """
+    measured = Measured(chunks)
+    for _ in measured:
+        pass
+    return measured.hexdigest(), measured.size
+
+
+READ_BACK_LIMIT = 1024 ** 2
+
+
+def remote_matches(manager, host, last, verify):
+    """
+    Check the whitelist on the server is still what was last uploaded, either by comparing its size ('stat'), or its
+    whole contents ('hash'). As an edit can leave the size the same, 'stat' compares the contents too if the size matches
+    and it's no more than `READ_BACK_LIMIT` bytes, which covers all but enormous whitelists.
+    """
+    try:
+        if verify == 'stat':
+            size = manager.stat(host, manager.whitelist).st_size
+            if size != last['size']:
+                return False
+            if size > READ_BACK_LIMIT:
+                return True
+        text = manager.read_text(host, manager.whitelist)
+        return hashlib.sha256(text.encode()).hexdigest() == last['digest']
+    except (OSError, FTPError):  # most likely it's not there
+        return False
+
+
+def update_whitelist(whitelist, force=False, verify=None, manager=None):
+    """
+    Upload whitelist to the server (or the sync target given by manager), skipping the upload if it's the same as last
+    time.
+
+    verify is one of 'none', 'stat' or 'hash' (defaults to `WHITELIST_SYNC_VERIFY`), and sets how the file on the server
+    is checked to still match before skipping. Returns 'unchanged', 'uploaded' or 'drift detected' (in which case the
+    whitelist is uploaded again).
+    """
+    verify = verify or current_app.config['WHITELIST_SYNC_VERIFY']
+    manager = manager or file_manager
+    digest, _ = measure(whitelist.iter_json())
+    last = sync_state.get(manager.location)
+    changed = force or not last or last['digest'] != digest
+    if not changed and verify == 'none':
+        return UNCHANGED  # without connecting at all
+
+    with manager.get_host() as host:
+        if changed:
+            status = UPLOADED
+        elif remote_matches(manager, host, last, verify):
+            return UNCHANGED
+        else:
+            status = DRIFTED
+
+        # whitelist is serialised a second time rather than held in memory, so measure what actually gets written.
+        written = Measured(whitelist.iter_json())
+        manager.write_chunks(host, manager.whitelist, written)
+
+    sync_state.set(manager.location, written.hexdigest(), written.size)
+    return status
+
+
+def update_targets(whitelist, force=False, verify=None, main=True):
+    """
+    Upload whitelist to every sync target at once, see `update_whitelist`. If not main, the main server is left out
+    (e.g. because it's been updated over RCON).
+
+    Each target gets its own thread, and `SYNC_TIMEOUT` seconds (or `<TARGET>_SYNC_TIMEOUT`) to finish, so a slow host
+    doesn't hold up the others. Returns a dict mapping each target's name to its status, 'timed out' or the error
+    raised. The threads are daemons, so one that's stuck on a host doesn't keep the process alive either.
+    """
+    managers = file_manager.targets()
+    if not main:
+        managers = managers[1:]
+    if not managers:
+        return {}
+    if len(managers) == 1:
+        manager, = managers
+        return {manager.name: update_whitelist(whitelist, force=force, verify=verify, manager=manager)}
+
+    app = current_app._get_current_object()
+    finished = {}
+
+    def update(manager):
+        with app.app_context():
+            try:
+                finished[manager.name] = update_whitelist(whitelist, force=force, verify=verify, manager=manager)
+            except Exception as e:
+                logger.error("Whitelist sync to {} failed: {}".format(manager.name, e))
+                finished[manager.name] = 'failed ({})'.format(e)
+
+    threads = [(manager, threading.Thread(target=update, args=(manager,), name='whitelist-target-' + manager.name,
+                                          daemon=True))
+               for manager in managers]
+    start = time.monotonic()
+    for _, thread in threads:
+        thread.start()
+
+    results = {}
+    for manager, thread in threads:
+        thread.join(timeout=max(0, start + manager.timeout - time.monotonic()))
+        if thread.is_alive():
+            logger.error("Whitelist sync to {} timed out".format(manager.name))
+            results[manager.name] = 'timed out'
+        else:
+            results[manager.name] = finished[manager.name]
+    return results
+
+
+def describe_results(results):
+    if len(results) == 1:
+        status, = results.values()
+        return status
+    return ', '.join('{}: {}'.format(name, status) for name, status in results.items())
+
+
+class RconError(Exception):
+    pass
+
+
+class RconClient:
+    """
+    Minimal client for Minecraft's RCON protocol, used as a context manager to connect and log in.
+    """
+    LOGIN = 3
+    COMMAND = 2
+    RESPONSE = 0  # sent after a command, as the server only answers it once the command's response is finished
+
+    def __init__(self, address, port, password, timeout):
+        self.address = address
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self._next_id = 0
+
+    def __enter__(self):
+        self.sock = socket.create_connection((self.address, self.port), timeout=self.timeout)
         try:
-            date = datetime.datetime.strptime(item.name, current_app.config['BACKUP_DIR_FORMAT'])
-            backups.append((date, item))
-        except ValueError as e:
-            continue
+            request_id = self._send(self.LOGIN, self.password)
+            response_id, _ = self._receive()
+            if response_id != request_id:
+                raise RconError("RCON login refused")
+        except BaseException:
+            self.sock.close()
+            raise
+        return self
 
-    backups.sort(key=lambda backup: backup[0])
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sock.close()
 
-    rotation = current_app.config['BACKUP_ROTATION'] - 1 # because I'll make a new one!
+    def command(self, command):
+        """
+        Run command, returning the server's response. Long responses are split over several packets, with nothing to
+        mark the last, so an empty packet is sent straight after the command, and the response to it marks the end.
+        """
+        request_id = self._send(self.COMMAND, command)
+        end_id = self._send(self.RESPONSE, '')
+        body = ''
+        while True:
+            response_id, fragment = self._receive()
+            if response_id == end_id:
+                return body
+            if response_id != request_id:
+                raise RconError("Unexpected RCON response to {!r}".format(command))
+            body += fragment
+
+    def _send(self, packet_type, body):
+        self._next_id += 1
+        payload = struct.pack('<ii', self._next_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+        self.sock.sendall(struct.pack('<i', len(payload)) + payload)
+        return self._next_id
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise RconError("RCON connection closed")
+            data += chunk
+        return data
+
+    def _receive(self):
+        length, = struct.unpack('<i', self._read(4))
+        response_id, _ = struct.unpack('<ii', self._read(8))
+        body = self._read(length - 8)[:-2]
+        return response_id, body.decode('utf-8')
+
+
+def rcon_client():
+    c = current_app.config
+    return RconClient(c['RCON_ADDRESS'], c['RCON_PORT'], c['RCON_PASSWORD'], c['RCON_TIMEOUT'])
+
+
+def rcon_listed(rcon):
+    """
+    Names on the server's whitelist, from `whitelist list`.
+    """
+    response = rcon.command('whitelist list')
+    if ':' not in response:  # "There are no whitelisted players"
+        return set()
+    return {name.strip() for name in response.split(':', 1)[1].split(',') if name.strip()}
+
+
+# replies to `whitelist add/remove` meaning the player's now (or already was) as wanted
+RCON_APPLIED = ('Added ', 'Removed ', 'Player is already whitelisted', 'Player is not whitelisted')
+
+
+def rcon_update(added, removed):
+    """
+    Apply just the changes to the server's whitelist, with `whitelist add/remove` commands. Returns the number sent.
+
+    Raises `RconError` if the server didn't apply any of them (e.g. "That player does not exist"), so that the sync
+    falls back to uploading whitelist.json instead.
+    """
+    names = set(added) | set(removed)
+    invalid = [name for name in names if not VALID_USERNAME.fullmatch(name)]
+    if invalid:
+        raise RconError("Can't send usernames {} over RCON".format(invalid))
+
+    commands = ['whitelist add {}'.format(name) for name in added] + \
+               ['whitelist remove {}'.format(name) for name in removed]
+    failed = []
+    with rcon_client() as rcon:
+        for command in commands:
+            reply = rcon.command(command)
+            if not reply.startswith(RCON_APPLIED):
+                failed.append("{!r} ({})".format(command, reply.strip() or 'no reply'))
+    if failed:
+        raise RconError("Server didn't apply {}".format(', '.join(failed)))
+    return len(names)
+
+
+def rcon_reconcile(whitelist):
+    """
+    Compare the server's whitelist with whitelist, and send commands to fix any differences.
+    """
+    with rcon_client() as rcon:
+        listed = {name.lower(): name for name in rcon_listed(rcon)}
+    wanted = {entry['name'].lower(): entry['name'] for entry in whitelist.iter_entries()}
+    return rcon_update([wanted[name] for name in wanted.keys() - listed.keys()],
+                       [listed[name] for name in listed.keys() - wanted.keys()])
+
+
+def sync_whitelist(whitelist, added=None, removed=None):
+    """
+    Bring the server's whitelist up to date.
+
+    If `RCON_ENABLED`, the main server is updated with RCON commands, just for the names added and removed if given,
+    otherwise by comparing against the server's current whitelist. whitelist.json is uploaded to the other sync targets
+    with `update_targets`, and to the main server too without RCON, or if it fails.
+    """
+    if current_app.config['RCON_ENABLED']:
+        try:
+            if added is None and removed is None:
+                n = rcon_reconcile(whitelist)
+            else:
+                n = rcon_update(added or (), removed or ())
+        except (OSError, RconError) as e:
+            logger.warning("RCON sync failed, falling back to {}: {}".format(file_manager.engine_name, e))
+        else:
+            results = {file_manager.name: 'sent {} changes over RCON'.format(n)}
+            results.update(update_targets(whitelist, main=False))
+            return describe_results(results)
+    return describe_results(update_targets(whitelist))
+
+
+class WhitelistSync:
+    """
+    Coalesces whitelist syncs, so requests don't wait on the server's file host.
+
+    `schedule` marks the whitelist as changed and returns immediately. A background thread then does a single sync for
+    all the changes made within `WHITELIST_SYNC_DELAY` seconds of the first. If the delay is 0, syncs happen straight
+    away instead.
+
+    If the usernames added or removed are given, and RCON is enabled, only those changes are sent to the server, see
+    `sync_whitelist`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._thread = None
+        self._app = None
+        self._whitelist = None
+        self._added = set()
+        self._removed = set()
+        self._full = False
+
+    def schedule(self, whitelist, added=None, removed=None):
+        if not current_app.config['WHITELIST_SYNC_DELAY']:
+            sync_whitelist(whitelist, added, removed)
+            return
+
+        with self._lock:
+            self._app = current_app._get_current_object()
+            self._whitelist = whitelist
+            self._queue(added, removed)
+            self._dirty.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='whitelist-sync', daemon=True)
+                self._thread.start()
+
+    def _queue(self, added, removed):
+        if added is None and removed is None:
+            self._full = True
+        for name in added or ():
+            self._removed.discard(name)
+            self._added.add(name)
+        for name in removed or ():
+            self._added.discard(name)
+            self._removed.add(name)
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self._app.config['WHITELIST_SYNC_DELAY'])  # let changes pile up
+            self.flush()
+
+    def flush(self):
+        """
+        Sync now if there are changes waiting.
+        """
+        with self._sync_lock:
+            if not self._dirty.is_set():
+                return
+
+            with self._lock:
+                self._dirty.clear()  # anything changing from here on needs another sync
+                added, removed, full = self._added, self._removed, self._full
+                self._added, self._removed, self._full = set(), set(), False
+
+            with self._app.app_context():
+                try:
+                    if full:
+                        status = sync_whitelist(self._whitelist)
+                    else:
+                        status = sync_whitelist(self._whitelist, added, removed)
+                    logger.info("Whitelist sync: {}".format(status))
+                except Exception:
+                    logger.exception("Whitelist sync failed, will retry")
+                    with self._lock:
+                        self._full = True  # don't know what made it, so check everything next time
+                        self._dirty.set()
+
+
+whitelist_sync = WhitelistSync()
+atexit.register(whitelist_sync.flush)
 
-    if len(backups) > rotation:
-        index = None if rotation == 0 else -rotation # because :0 is different to :None.
-        return backups[:index]
-    else:
-        return []
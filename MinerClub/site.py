@@ -1,15 +1,21 @@
 from pathlib import Path
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import datetime
+import time
 
 from flask import render_template, request, Blueprint, current_app
 import click
 
-from MinerClub.database import Member, Whitelist, db
+from MinerClub.database import Member, Whitelist, Outbox, db, header_safe
 
 from .config import Messages
-from MinerClub.membership import get_mj_id
-from MinerClub.membership import is_member
-from MinerClub.server_comms import update_whitelist, get_now, file_manager, outdated_backups
+from MinerClub import migrations
+from MinerClub.membership import get_mj_id, find_renames, MojangUnavailable
+from MinerClub.membership import is_member, member_index
+from MinerClub.server_comms import update_targets, describe_results, sync_whitelist, whitelist_sync, file_manager
+from MinerClub.backups import get_now, list_backups, outdated_backups, run_backup, archive_backup
+from MinerClub.backups import trash_backups, empty_trash, empty_trash_in_background, BackupFilter, filter_summary
 
 minerclub = Blueprint('minerclub', __name__)
 
@@ -41,8 +47,8 @@ def activate():
         u = Member(id=member_id)
         db.session.add(u)
 
-        current_app.logger.debug("Sending activation email")
-        u.send_activate_email()
+        current_app.logger.debug("Queueing activation email")
+        u.queue_activate_email()
 
         current_app.logger.debug("Committing changes")
         db.session.commit()
@@ -61,6 +67,10 @@ def register():
                                         request.form.get('username'),
                                         request.form.get('email'))
 
+        if not header_safe(email):
+            current_app.logger.warn("Attempted registration with invalid email {!r}".format(email))
+            return render_template("message.html", bad=Messages.INVALID_EMAIL)
+
         sponsor = Member.query.filter_by(sponsor_code=sponsor_code.strip()).first()
 
         if sponsor is None:
@@ -71,7 +81,11 @@ def register():
             current_app.logger.warn("Attempted registration for Member {} who's quota is done".format(sponsor.id))
             return render_template("message.html", bad=Messages.OUTTA_GUESTS)
 
-        mj_id = get_mj_id(username)
+        try:
+            mj_id = get_mj_id(username)
+        except MojangUnavailable as e:
+            current_app.logger.error("Unable to check MJ username {}: {}".format(username, e))
+            return render_template("message.html", bad=Messages.MOJANG_UNAVAILABLE)
 
         if mj_id is None:
             current_app.logger.warn("Attempted registration for invalid MJ username {}".format(username))
@@ -84,15 +98,22 @@ def register():
         current_app.logger.debug("Creating new whitelist entry")
         w = Whitelist(username=username, sponsor=sponsor, id=mj_id, email=email)
         db.session.add(w)
+        db.session.flush()  # counts w against sponsor's quota, holding their row until commit
+
+        db.session.refresh(sponsor)
+        if sponsor.quota < 0:  # someone else registered with this sponsor in the meantime
+            db.session.rollback()
+            current_app.logger.warn("Attempted registration for Member {} who's quota is done".format(sponsor.id))
+            return render_template("message.html", bad=Messages.OUTTA_GUESTS)
 
-        current_app.logger.debug("Sending registration emails for {}".format(w))
-        w.send_register_emails()
+        current_app.logger.debug("Queueing registration emails for {}".format(w))
+        w.queue_register_emails()
 
         current_app.logger.debug("Committing changes")
         db.session.commit()
 
-        current_app.logger.debug("Syncing whitelists")
-        update_whitelist(Whitelist)
+        current_app.logger.debug("Scheduling whitelist sync")
+        whitelist_sync.schedule(Whitelist, added=[username])
 
         current_app.logger.info("Successful registration of {} sponsored by {}".format(username, sponsor.id))
         return render_template("message.html", good=Messages.REGISTER_SUCCESS.format(email=email))
@@ -108,9 +129,17 @@ def privacy():
 @minerclub.cli.command("init", help="Initialise application database")
 def init_db():
     click.echo("Creating database")
-    db.create_all()
-    click.echo("Committing change")
-    db.session.commit()
+    # an existing database is upgraded, as create_all won't add columns to tables that are already there
+    for name in migrations.upgrade():
+        click.echo("Applied {}".format(name))
+    click.echo("Success")
+
+
+@minerclub.cli.command("migrate", help="Upgrade a database made by an older version of MinerClub")
+def migrate():
+    click.echo("Upgrading database")
+    for name in migrations.upgrade():
+        click.echo("Applied {}".format(name))
     click.echo("Success")
 
 
@@ -122,40 +151,198 @@ def reset_db():
     click.echo("Recreating them")
     db.create_all()
     db.session.commit()
+    migrations.stamp()
     click.echo("Success")
 
 
+@minerclub.cli.command("check-quotas", help="Check each member's guest count matches their whitelist entries.")
+@click.option('--fix/--no-fix', default=False, help="Correct any counts found to be wrong.")
+def check_quotas(fix):
+    miscounted = Member.miscounted()
+    for member_id, counted, actual in miscounted:
+        click.echo("Member '{}' has {} guests, but is counted as having {}".format(member_id, actual, counted))
+
+    if not miscounted:
+        click.echo("All guest counts correct")
+    elif fix:
+        click.echo("Recounting guests")
+        Member.recount_guests()
+        click.echo("Success")
+
+
 @minerclub.cli.command("force-sync", help="Force overwriting of server whitelist with MinerClub whitelist.")
-def force_sync():
+@click.option('--force/--no-force', default=False, help="Upload even if nothing has changed since the last sync.")
+@click.option('--verify', type=click.Choice(['none', 'stat', 'hash']), default=None,
+              help="How to check the server's whitelist is unchanged (defaults WHITELIST_SYNC_VERIFY)")
+@click.option('--rcon/--no-rcon', default=False, help="Sync over RCON (if RCON_ENABLED) rather than uploading the file.")
+def force_sync(force, verify, rcon):
     click.echo("Forcing whitelist sync")
-    update_whitelist(Whitelist)
+    if rcon:
+        status = sync_whitelist(Whitelist)
+    else:
+        status = describe_results(update_targets(Whitelist, force=force, verify=verify))
+    click.echo("Whitelist {}".format(status))
     click.echo("Success")
 
 
+@minerclub.cli.command("member-stats", help="Show the state of the members list index.")
+def member_stats():
+    member_index.refresh()
+    click.echo("{} members loaded from {} in {:.3f}s at {}".format(
+        member_index.count, member_index.path, member_index.load_time,
+        datetime.datetime.fromtimestamp(member_index.loaded_at).isoformat()))
+
+
+@minerclub.cli.command("refresh-profiles", help="Update whitelist entries of players who have changed username.")
+@click.option('--page-size', type=int, default=500, help="Number of whitelist entries read from the database at a time.")
+@click.option('--workers', type=int, default=2, help="Number of pages checked against Mojang concurrently.")
+def refresh_profiles(page_size, workers):
+    app = current_app._get_current_object()
+
+    def check(page):
+        with app.app_context():
+            return find_renames(page)
+
+    start = time.perf_counter()
+    checked = 0
+    renames = []
+    in_flight = collections.deque()
+
+    with ThreadPoolExecutor(workers) as pool:
+        for page in Whitelist.pages(page_size):
+            in_flight.append(pool.submit(check, page))
+            checked += len(page)
+            if len(in_flight) >= workers * 2:  # don't read ahead of Mojang too much
+                renames.extend(in_flight.popleft().result())
+        while in_flight:
+            renames.extend(in_flight.popleft().result())
+
+    renamed = Whitelist.rename_all(renames)
+    for old, new in renamed:
+        click.echo("'{}' is now '{}'".format(old, new))
+
+    elapsed = time.perf_counter() - start
+    click.echo("Checked {} entries in {:.1f}s ({:.1f} entries/s), {} renamed".format(
+        checked, elapsed, checked / elapsed if elapsed else 0, len(renamed)))
+
+    if renamed:
+        click.echo("Syncing whitelists")
+        sync_whitelist(Whitelist)
+    click.echo("Complete")
+
+
+@minerclub.cli.command("mail-worker", help="Send queued emails.")
+@click.option('--batch-size', type=int, default=None, help="Number of emails to send per batch (defaults MAIL_BATCH_SIZE)")
+@click.option('--watch/--once', default=False, help="Keep polling for new emails rather than exiting when done.")
+@click.option('--interval', type=float, default=5, help="Seconds to wait between polls when watching.")
+def mail_worker(batch_size, watch, interval):
+    while True:
+        sent, failed = Outbox.send_pending(batch_size)
+        if sent or failed:
+            click.echo("Sent {} emails, {} failed".format(sent, failed))
+        if not sent:  # nothing left that's due
+            if not watch:
+                break
+            time.sleep(interval)
+    click.echo("Complete")
+
+
 @minerclub.cli.command('backup', help="Perform backup of server folders")
 @click.option('--cycle/--no-cycle', default=True, help="Delete old backups? (defaults true)")
-def backup(cycle):
+@click.option('--mode', type=click.Choice(['full', 'incremental', 'snapshot', 'archive']), default=None,
+              help="Copy everything, only what's changed since the last backup, only what's changed, hard-linking "
+                   "the rest to the last backup, or everything into a compressed archive (defaults BACKUP_MODE)")
+@click.option('--dry-run', is_flag=True, help="Just show what BACKUP_EXCLUDE would leave out, without backing up.")
+@click.option('--resume', is_flag=True, help="Carry on with the last backup that was interrupted, rather than "
+                                             "starting a new one.")
+def backup(cycle, mode, dry_run, resume):
+    if dry_run:
+        sources = current_app.config['BACKUP_SOURCES']
+        with file_manager.get_host() as host:
+            (files, size), skipped = filter_summary(host, sources, BackupFilter())
+        for path, (n, skipped_size) in skipped.items():
+            click.echo("Would skip '{}' - {} files ({:.1f} MB)".format(path, n, skipped_size / 1e6))
+        click.echo("Would skip {} files ({:.1f} MB), and back up {} files ({:.1f} MB)".format(
+            sum(n for n, _ in skipped.values()), sum(b for _, b in skipped.values()) / 1e6, files, size / 1e6))
+        return
+
+    mode = mode or current_app.config['BACKUP_MODE']
+    partial = [(date, item) for date, item in list_backups(partial=True) if item.is_dir()]  # archives can't be resumed
+    if resume and mode == 'archive':
+        raise click.ClickException("Archives can't be resumed")
+    if resume and not partial:
+        raise click.ClickException("No interrupted backup to resume")
+
+    outdated = outdated_backups() if cycle else []
+    # an incremental backup copies from the last one, so that's left until the new one's made
+    held_back = outdated[-1:] if mode in ('incremental', 'snapshot') else []
+    pruning = None
+
     if cycle:
         click.echo("Cleaning up old backups")
         click.echo("Keeping roation of {} backups".format(current_app.config['BACKUP_ROTATION']))
-        outdated = outdated_backups()
         for date, folder in outdated:
-            click.echo("'{}' outdated - removing".format(folder.path, date))
-            shutil.rmtree(folder.path)
-            click.echo("Success")
+            click.echo("'{}' outdated - removing".format(folder.path))
+        trash_backups(outdated[:len(outdated) - len(held_back)])
+        pruning = empty_trash_in_background()
 
     sources = current_app.config['BACKUP_SOURCES']
-    destination = Path(current_app.config['BACKUP_DESTINATION']) / get_now()
-
-    click.echo("Backing up {} to {}".format(sources, destination))
+    if resume:
+        _, latest = partial.pop()
+        destination = Path(latest.path)
+        click.echo("Resuming backup of {} to {}".format(sources, destination))
+    else:
+        destination = Path(current_app.config['BACKUP_DESTINATION']) / get_now()
+        click.echo("Backing up {} to {}".format(sources, destination))
+
+    if partial:
+        click.echo("{} interrupted backups left, use --resume to carry on with the latest, or prune-backups to remove "
+                   "them".format(len(partial)))
 
-    click.echo("Making backup directory")
-    destination.mkdir()
-    click.echo("Success")
     with file_manager.get_host() as host:
-        for source in sources:
-            click.echo("Copying {} to {}".format(source, destination))
-            file_manager.copy_dir(host, source, destination)
-            click.echo("Success")
+        if mode == 'archive':
+            click.echo("Archiving {} with {} compression".format(sources, current_app.config['BACKUP_COMPRESSION']))
+            archive, stats = archive_backup(host, sources, destination)
+            click.echo("Success, {} written to {}".format(stats, archive))
+        else:
+            if not resume:
+                click.echo("Making backup directory")
+                destination.mkdir()
+                click.echo("Success")
+
+            click.echo("Copying {} to {} ({} backup over {} connections)".format(
+                sources, destination, mode, current_app.config['BACKUP_CONNECTIONS']))
+            stats = run_backup(host, sources, destination, mode)
+            click.echo("Success, {}".format(stats))
+
+    if cycle:
+        click.echo("Waiting for old backups to be removed")
+        pruning.join()  # before trashing any more, as it removes the trash directory once it's emptied
+        trash_backups(held_back)
+        empty_trash()
+        click.echo("Success")
+
+    click.echo("Complete")
+
 
+@minerclub.cli.command('prune-backups', help="Remove outdated backups, and any left in the trash.")
+@click.option('--workers', type=int, default=None, help="Number of directories removed at once "
+                                                         "(defaults BACKUP_PRUNE_WORKERS)")
+@click.option('--partial/--no-partial', default=True, help="Remove interrupted backups too? (defaults true)")
+def prune_backups(workers, partial):
+    outdated = outdated_backups(keep=current_app.config['BACKUP_ROTATION'])
+    for date, folder in outdated:
+        click.echo("'{}' outdated - removing".format(folder.path))
+    trash_backups(outdated)
+
+    if partial:
+        # unfinished archives are outdated already
+        interrupted = [(date, item) for date, item in list_backups(partial=True) if item.is_dir()]
+        for date, folder in interrupted:
+            click.echo("'{}' interrupted - removing".format(folder.path))
+        trash_backups(interrupted)
+
+    start = time.perf_counter()
+    removed = empty_trash(workers)
+    click.echo("Removed {} backups in {:.1f}s".format(removed, time.perf_counter() - start))
     click.echo("Complete")
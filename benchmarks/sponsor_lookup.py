@@ -0,0 +1,51 @@
+"""
+Time looking up members by sponsor code (as done on every registration), with and without the sponsor_code index.
+
+Run from the top-level directory, e.g. `python -m benchmarks.sponsor_lookup 10000`
+"""
+import os
+import sys
+import time
+
+from MinerClub import create_app
+from MinerClub.database import db, Member
+
+
+def time_lookups(codes):
+    start = time.perf_counter()
+    for code in codes:
+        Member.query.filter_by(sponsor_code=code).first()
+    return (time.perf_counter() - start) / len(codes)
+
+
+def main(n_members=10000, n_lookups=200):
+    app = create_app('testing')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        members = [Member(id='member{}'.format(i)) for i in range(n_members)]
+        db.session.bulk_insert_mappings(Member, [{'id': m.id, 'sponsor_code': m.sponsor_code, 'email': m.email}
+                                                 for m in members])
+        db.session.commit()
+
+        step = max(1, n_members // n_lookups)
+        codes = [m.sponsor_code for m in members[::step]]
+
+        indexed = time_lookups(codes)
+        db.session.execute("DROP INDEX ix_member_sponsor_code")
+        db.session.commit()
+        unindexed = time_lookups(codes)
+
+        print("{} members, {} lookups".format(n_members, len(codes)))
+        print("With index:    {:8.3f} ms per lookup".format(indexed * 1000))
+        print("Without index: {:8.3f} ms per lookup".format(unindexed * 1000))
+        print("Speed up:      {:8.1f}x".format(unindexed / indexed))
+
+        db.drop_all()
+        db.engine.dispose()
+    os.remove(app.config['DATABASE_FILE'])
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,70 @@
+"""
+Compare time and peak memory of serialising the whitelist the old way (load every row, format each UUID character by
+character, dump the whole list to one indented string) against streaming compact JSON chunks.
+
+Run from the top-level directory, e.g. `python -m benchmarks.whitelist_export 100000`
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from MinerClub import create_app
+from MinerClub.database import db, Member, Whitelist
+
+
+def old_export(out):
+    entries = Whitelist.query.all()
+    data = [{'uuid': "{}{}{}{}{}{}{}{}-{}{}{}{}-{}{}{}{}-{}{}{}{}-{}{}{}{}{}{}{}{}{}{}{}{}".format(*entry.id),
+             'name': entry.username} for entry in entries]
+    out.write(json.dumps(data, indent=4))
+
+
+def new_export(out):
+    for chunk in Whitelist.iter_json():
+        out.write(chunk)
+
+
+def profile(export):
+    db.session.expunge_all()
+    with open(os.devnull, 'w') as out:
+        tracemalloc.start()
+        start = time.perf_counter()
+        export(out)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(n_entries=100000):
+    app = create_app('testing')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        sponsor = Member(id='sponsor')
+        db.session.add(sponsor)
+        db.session.commit()
+
+        db.session.bulk_insert_mappings(Whitelist, [{'username': 'Player{}'.format(i),
+                                                     'id': '{:032x}'.format(i),
+                                                     'email': 'player{}@example.com'.format(i),
+                                                     'member_id': sponsor.id} for i in range(n_entries)])
+        db.session.commit()
+
+        old_time, old_peak = profile(old_export)
+        new_time, new_peak = profile(new_export)
+
+        print("{} whitelist entries".format(n_entries))
+        print("Old: {:8.3f} s, {:8.1f} MiB peak".format(old_time, old_peak / 2 ** 20))
+        print("New: {:8.3f} s, {:8.1f} MiB peak".format(new_time, new_peak / 2 ** 20))
+
+        db.drop_all()
+        db.engine.dispose()
+    os.remove(app.config['DATABASE_FILE'])
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
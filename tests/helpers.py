@@ -1,5 +1,8 @@
+import json
 import socket
+import struct
 import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from pyftpdlib.servers import FTPServer
 from pyftpdlib.authorizers import DummyAuthorizer
@@ -47,6 +50,158 @@ class TestSFTPServer(TestServer):
         self.thread.join()
 
 
+class TestMojangServer(TestServer):
+    """
+    Stands in for the Mojang API. `profiles` maps usernames to IDs, set `status` to make it respond with an error. Like
+    Mojang, batches containing any of the names in `rejected` get a 400.
+    """
+
+    def __init__(self, address, port, profiles):
+        self.profiles = profiles
+        self.status = 200
+        self.rejected = set()
+        self.requests = []
+        self.httpd = HTTPServer((address, port), make_mojang_handler(self))
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+def make_mojang_handler(server):
+
+    class MojangHandler(BaseHTTPRequestHandler):
+
+        def respond(self, status, data=None):
+            body = json.dumps(data).encode() if data is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            names = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            server.requests.append(names)
+
+            if server.status != 200:
+                return self.respond(server.status)
+
+            if server.rejected & set(names):
+                return self.respond(400, {'error': 'IllegalArgumentException'})
+
+            profiles = {name.lower(): (name, mj_id) for name, mj_id in server.profiles.items()}
+            found = [profiles[name.lower()] for name in names if name.lower() in profiles]
+            self.respond(200, [{'id': mj_id, 'name': name} for name, mj_id in found])
+
+        def do_GET(self):
+            server.requests.append(self.path)
+
+            if server.status != 200:
+                return self.respond(server.status)
+
+            mj_id = self.path.rsplit('/', 1)[-1]
+            for name, profile_id in server.profiles.items():
+                if profile_id == mj_id:
+                    return self.respond(200, {'id': mj_id, 'name': name})
+            self.respond(204)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MojangHandler
+
+
+class TestRconServer(TestServer):
+    """
+    Pretends to be a Minecraft server's RCON, keeping track of whitelist commands in `whitelist`. Names in `missing`
+    are treated as players that don't exist.
+    """
+
+    def __init__(self, address, port, password):
+        self.whitelist = set()
+        self.missing = set()
+        self.commands = []
+        self.event = threading.Event()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=run_rcon_server, args=[self, address, port, password])
+
+    def __enter__(self):
+        super().__enter__()
+        self.ready.wait()
+
+    def stop(self):
+        self.event.set()
+        self.thread.join()
+
+    def run_command(self, command):
+        self.commands.append(command)
+        args = command.split()
+        if args[:2] in (['whitelist', 'add'], ['whitelist', 'remove']) and args[2] in self.missing:
+            return "That player does not exist"
+        if args[:2] == ['whitelist', 'add']:
+            if args[2] in self.whitelist:
+                return "Player is already whitelisted"
+            self.whitelist.add(args[2])
+            return "Added {} to the whitelist".format(args[2])
+        if args[:2] == ['whitelist', 'remove']:
+            if args[2] not in self.whitelist:
+                return "Player is not whitelisted"
+            self.whitelist.discard(args[2])
+            return "Removed {} from the whitelist".format(args[2])
+        if args[:2] == ['whitelist', 'list']:
+            if not self.whitelist:
+                return "There are no whitelisted players"
+            return "There are {} whitelisted players: {}".format(len(self.whitelist), ', '.join(sorted(self.whitelist)))
+        return "Unknown command"
+
+
+def run_rcon_server(server, address, port, password):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    server_socket.bind((address, port))
+    server_socket.listen(10)
+    server_socket.settimeout(0.5)
+    server.ready.set()
+
+    def send(conn, request_id, body):
+        payload = struct.pack('<ii', request_id, 2) + body.encode() + b'\x00\x00'
+        conn.sendall(struct.pack('<i', len(payload)) + payload)
+
+    while not server.event.is_set():
+        try:
+            conn, addr = server_socket.accept()
+        except socket.timeout:
+            continue
+
+        with conn:
+            conn.settimeout(2)
+            logged_in = False
+            while True:
+                try:
+                    header = conn.recv(12, socket.MSG_WAITALL)
+                except socket.timeout:
+                    break
+                if len(header) < 12:
+                    break
+                length, request_id, packet_type = struct.unpack('<iii', header)
+                body = conn.recv(length - 8, socket.MSG_WAITALL)[:-2].decode()
+
+                if packet_type == 3:
+                    logged_in = body == password
+                    send(conn, request_id if logged_in else -1, '')
+                elif logged_in and packet_type == 2:
+                    response = server.run_command(body)
+                    for start in range(0, max(len(response), 1), 4096):  # split up like Minecraft's
+                        send(conn, request_id, response[start:start + 4096])
+                elif logged_in:
+                    send(conn, request_id, 'Unknown request {:x}'.format(packet_type))
+
+    server_socket.close()
+
+
 def run_ftp_server(username, password, address, port, use_ssl, top_dir, loop):
     authorizer = DummyAuthorizer()
     authorizer.add_user(username,
@@ -1,22 +1,39 @@
 import time
 import json
+import collections
+import errno
+import stat
+import tarfile
+import io
+import threading
 from pathlib import Path
 import os
 import datetime
+import smtplib
 
 import pytest
 
 from flask import render_template
 
 from MinerClub import mail, create_app
+from MinerClub.emailer import transport, make_email
 from MinerClub.database import db
 from MinerClub.config import get_config, Messages
-from MinerClub.site import reset_db, force_sync, backup
-from MinerClub.database import Member, Whitelist
-from MinerClub.membership import is_member
-from MinerClub.server_comms import file_manager, get_now, outdated_backups
-
-from .helpers import TestFTPServer, TestSFTPServer
+from MinerClub import site, migrations
+from MinerClub.site import init_db, reset_db, force_sync, backup, mail_worker, refresh_profiles, check_quotas, migrate
+from MinerClub.site import prune_backups
+from MinerClub.database import Member, Whitelist, Outbox
+from MinerClub import membership
+from MinerClub.membership import is_member, profile_cache, MemberIndex, get_mj_ids, MojangClient, MojangUnavailable
+from MinerClub import server_comms
+from MinerClub.server_comms import file_manager, update_whitelist, sync_whitelist, WhitelistSync
+from MinerClub.server_comms import update_targets, LocalFileEngine, FastCopier, FileManager
+from MinerClub.server_comms import RconClient, RconError, rcon_update
+from MinerClub.backups import get_now, list_backups, outdated_backups, Manifest, Transfers, BackupError
+from MinerClub.backups import ARCHIVE_SUFFIXES, TRASH, remote_files, trash_backups, BackupFilter, Progress
+from MinerClub.backups import segmented_download
+
+from .helpers import TestFTPServer, TestSFTPServer, TestMojangServer, TestRconServer
 
 TestingConfig = get_config('testing')
 app = create_app('testing')
@@ -100,6 +117,7 @@ def with_engine(server_filesystem, monkeypatch, request):
         else:
             with server:
                 yield server_home
+                file_manager.close_all()  # connections to this server are no use after
 
 
 def test_config_loading():
@@ -117,6 +135,26 @@ def test_config_loading():
     get_config('product')
 
 
+def test_target_config(monkeypatch):
+    for key in dir(TestingConfig):
+        if not key.startswith('__'):
+            monkeypatch.setenv(key, str(getattr(TestingConfig, key)))
+    monkeypatch.setenv('FILE_ENGINE', 'SFTP')
+    monkeypatch.setenv('SYNC_TARGETS', 'creative')
+    monkeypatch.setenv('CREATIVE_SFTP_SERVER_ADDRESS', 'creative.host')
+
+    config = get_config('product')
+    assert config.CREATIVE_FILE_ENGINE == 'SFTP'
+    assert config.CREATIVE_SFTP_SERVER_ADDRESS == 'creative.host'
+    assert config.CREATIVE_SFTP_SERVER_USERNAME == config.SFTP_SERVER_USERNAME  # the rest is the main server's
+    assert config.CREATIVE_SFTP_SERVER_PORT == config.SFTP_SERVER_PORT
+    assert config.CREATIVE_SYNC_TIMEOUT == config.SYNC_TIMEOUT
+
+    monkeypatch.setenv('CREATIVE_FILE_ENGINE', 'FTP')  # the main server has no FTP settings to fall back on
+    with pytest.raises(ValueError, match='Required config value CREATIVE_FTP_SERVER_ADDRESS not set'):
+        get_config('product')
+
+
 def test_member():
     assert is_member(good_member) is True
     assert is_member(bad_member) is False
@@ -137,7 +175,14 @@ def test_activate(client):
                                    good=Messages.ACTIVATE_SUCCESS.format(
                                    email=app.config['EMAIL_TEMPLATE'].format(good_member)))
 
+    assert len(outbox) == 0
+    assert len(Outbox.query.all()) == 1
+
+    with mail.record_messages() as outbox:
+        assert app.test_cli_runner().invoke(mail_worker).exception is None
+
     assert len(outbox) == 1
+    assert len(Outbox.query.all()) == 0
 
     CLUB_NAME = app.config['CLUB_NAME']
 
@@ -165,6 +210,7 @@ def test_activate(client):
 def test_register(client, with_engine, server_filesystem):
 
     resp = activate(client, good_memb_code, good_member)
+    Outbox.send_pending()  # clear activation email
     resp = register(client, bad_sponse_code, good_email, good_mc_user)
 
     assert resp == render_template("message.html", bad=Messages.WRONG_SPONSOR_CODE)
@@ -175,8 +221,10 @@ def test_register(client, with_engine, server_filesystem):
 
     assert resp == render_template("message.html", bad=Messages.UNKNOWN_USERNAME)
 
+    resp = register(client, user.sponsor_code, good_email, good_mc_user)
+
     with mail.record_messages() as outbox:
-        resp = register(client, user.sponsor_code, good_email, good_mc_user)
+        assert app.test_cli_runner().invoke(mail_worker).exception is None
 
     CLUB_NAME = app.config['CLUB_NAME']
 
@@ -312,3 +360,1047 @@ def test_cli(client, monkeypatch, with_engine, tmp_path, server_filesystem):
     backups = os.listdir(backups_dir)
     assert all(item not in backups for item in outdated) is True
     assert len(backups) == app.config['BACKUP_ROTATION']
+
+
+def test_incremental_backup(client, monkeypatch, with_engine, tmp_path):
+    server_home = with_engine
+    (server_home / 'basedir' / 'same.txt').write_text('unchanged')
+    (server_home / 'basedir' / 'subdir' / 'changes.txt').write_text('before')
+    (server_home / 'basedir' / 'empty').mkdir()
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_ROTATION', 2)
+    monkeypatch.setitem(app.config, 'BACKUP_DIR_FORMAT', '%y-%m-%d_(%Hh%Mm%Ss%fms)')
+
+    downloaded = []
+    engine = type(file_manager.engine)
+    download = engine.download
+
+    def spy(self, host, source, destination):
+        downloaded.append(source)
+        download(self, host, source, destination)
+
+    monkeypatch.setattr(engine, 'download', spy)
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(backup, ['--mode', 'incremental']).exception is None
+    assert sorted(downloaded) == ['basedir/same.txt', 'basedir/subdir/changes.txt']
+
+    (server_home / 'basedir' / 'subdir' / 'changes.txt').write_text('after, and longer')
+    (server_home / 'basedir' / 'new.txt').write_text('new')
+
+    downloaded.clear()
+    assert runner.invoke(backup, ['--mode', 'incremental']).exception is None
+    assert sorted(downloaded) == ['basedir/new.txt', 'basedir/subdir/changes.txt']
+
+    assert len(list_backups()) == 2
+    latest = Path(list_backups()[-1][1].path)
+    assert (latest / 'basedir' / 'same.txt').read_text() == 'unchanged'
+    assert (latest / 'basedir' / 'subdir' / 'changes.txt').read_text() == 'after, and longer'
+    assert (latest / 'basedir' / 'new.txt').read_text() == 'new'
+    assert (latest / 'basedir' / 'empty').is_dir()
+    assert set(Manifest.load(latest).files) == {'basedir/same.txt', 'basedir/new.txt', 'basedir/subdir/changes.txt'}
+
+
+def test_snapshot_backup(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    (server_home / 'basedir').mkdir(parents=True)
+    (server_home / 'basedir' / 'same.txt').write_text('unchanged')
+    (server_home / 'basedir' / 'changes.txt').write_text('before')
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_ROTATION', 3)
+    monkeypatch.setitem(app.config, 'BACKUP_DIR_FORMAT', '%y-%m-%d_(%Hh%Mm%Ss%fms)')
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(backup, ['--mode', 'snapshot']).exception is None
+    (server_home / 'basedir' / 'changes.txt').write_text('after, and longer')
+    assert runner.invoke(backup, ['--mode', 'snapshot']).exception is None
+
+    first, second = [Path(item.path) / 'basedir' for _, item in list_backups()]
+    assert os.path.samefile(first / 'same.txt', second / 'same.txt')
+    assert os.stat(second / 'same.txt').st_nlink == 2
+    assert not os.path.samefile(first / 'changes.txt', second / 'changes.txt')
+    assert (first / 'changes.txt').read_text() == 'before'
+    assert (second / 'changes.txt').read_text() == 'after, and longer'
+
+
+def test_backup_transfers(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    server_home.mkdir()
+    for i in range(20):
+        (server_home / 'file{}.txt'.format(i)).write_text(str(i))
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+
+    attempts = collections.Counter()
+    threads = set()
+    download = LocalFileEngine.download
+
+    def flaky_download(self, host, source, destination):
+        attempts[source] += 1
+        threads.add(threading.current_thread().name)
+        time.sleep(0.01)
+        if source == 'broken.txt' or (source == 'file3.txt' and attempts[source] == 1):
+            raise OSError("Connection lost")
+        download(self, host, source, destination)
+
+    monkeypatch.setattr(LocalFileEngine, 'download', flaky_download)
+
+    destination = tmp_path / 'backup'
+    with Transfers(connections=4, retries=1) as transfers:
+        for i in range(20):
+            transfers.put('file{}.txt'.format(i), destination / 'nested' / 'file{}.txt'.format(i))
+
+    assert len(threads) > 1
+    assert attempts['file3.txt'] == 2
+    assert all((destination / 'nested' / 'file{}.txt'.format(i)).read_text() == str(i) for i in range(20))
+
+    with pytest.raises(BackupError, match='broken.txt'):
+        with Transfers(connections=2, retries=1) as transfers:
+            transfers.put('broken.txt', destination / 'broken.txt')
+    assert attempts['broken.txt'] == 2
+
+
+@pytest.mark.parametrize('codec', ['gz', 'xz', 'none'])
+def test_archive_backup(client, monkeypatch, tmp_path, codec):
+    server_home = tmp_path / 'server'
+    (server_home / 'basedir' / 'subdir').mkdir(parents=True)
+    (server_home / 'basedir' / 'level.dat').write_bytes(os.urandom(1000))
+    (server_home / 'basedir' / 'subdir' / 'log.txt').write_text('compresses well ' * 1000)
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_ROTATION', 1)
+    monkeypatch.setitem(app.config, 'BACKUP_COMPRESSION', codec)
+    monkeypatch.setitem(app.config, 'BACKUP_DIR_FORMAT', '%y-%m-%d_(%Hh%Mm%Ss%fms)')
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(backup, ['--mode', 'archive']).exception is None
+
+    (archive,) = backups_dir.iterdir()
+    assert archive.name.endswith(ARCHIVE_SUFFIXES[codec])
+    with tarfile.open(archive) as tar:
+        assert set(tar.getnames()) == {'basedir', 'basedir/subdir', 'basedir/level.dat', 'basedir/subdir/log.txt'}
+        assert tar.extractfile('basedir/level.dat').read() == (server_home / 'basedir' / 'level.dat').read_bytes()
+        assert tar.extractfile('basedir/subdir/log.txt').read().decode() == 'compresses well ' * 1000
+
+    unfinished = backups_dir / ('20-01-01_(00h00m00s000000ms)' + ARCHIVE_SUFFIXES[codec] + '.partial')
+    unfinished.write_bytes(b'interrupted')
+
+    assert [item.path for _, item in list_backups()] == [str(archive)]
+    assert [item.path for _, item in list_backups(partial=True)] == [str(unfinished)]
+    assert runner.invoke(backup, ['--mode', 'full']).exception is None
+    assert not archive.exists()  # rotated out like any other backup
+    assert not unfinished.exists()
+    assert len(list_backups()) == 1
+
+
+def test_archive_changing_file(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    (server_home / 'basedir').mkdir(parents=True)
+    (server_home / 'basedir' / 'level.dat').write_bytes(os.urandom(1000))
+    (server_home / 'basedir' / 'session.lock').write_bytes(b'locked')
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_COMPRESSION', 'none')
+
+    open_read = LocalFileEngine.open_read
+
+    def shrinking_open_read(self, host, path):
+        f = open_read(self, host, path)
+        if path.endswith('level.dat'):  # saved part way through the backup
+            with f:
+                return io.BytesIO(f.read(400))
+        return f
+
+    monkeypatch.setattr(LocalFileEngine, 'open_read', shrinking_open_read)
+
+    result = app.test_cli_runner().invoke(backup, ['--mode', 'archive', '--no-cycle'])
+    assert result.exception is None
+    assert '1 shrank while being archived' in result.output
+
+    (archive,) = backups_dir.iterdir()
+    with tarfile.open(archive) as tar:
+        level = tar.extractfile('basedir/level.dat').read()
+        assert level == (server_home / 'basedir' / 'level.dat').read_bytes()[:400] + bytes(600)
+        assert tar.extractfile('basedir/session.lock').read() == b'locked'  # the rest carries on as normal
+
+
+def test_remote_files(with_engine):
+    server_home = with_engine
+    (server_home / 'basedir' / 'a.txt').write_text('a' * 10)
+    (server_home / 'basedir' / 'subdir' / 'b.txt').write_text('b' * 20)
+
+    with file_manager.get_host() as host:
+        if file_manager.engine_name == 'SFTP':
+            root, dirs, files = next(iter(file_manager.walk(host, 'basedir')))
+            assert dirs == ['subdir'] and stat.S_ISDIR(dirs[0].attrs.st_mode)
+            assert {f: f.attrs.st_size for f in files} == {'a.txt': 10}
+
+        found = {name.as_posix(): attrs and attrs.st_size for _, name, attrs in remote_files(host, 'basedir')}
+
+    assert found == {'basedir': None, 'basedir/a.txt': 10, 'basedir/subdir': None, 'basedir/subdir/b.txt': 20}
+
+
+def test_segmented_download(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    server_home.mkdir()
+    data = os.urandom(100000)
+    (server_home / 'r.0.0.mca').write_bytes(data)
+    (server_home / 'small.dat').write_bytes(b'small')
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENT_THRESHOLD', 1000)
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENT_SIZE', 30000)
+    monkeypatch.setattr(LocalFileEngine, 'SEGMENTED', True)
+
+    ranges = []
+    download_range = LocalFileEngine.download_range
+
+    def spy(self, host, source, destination, offset, length):
+        ranges.append((source, offset, length))
+        return download_range(self, host, source, destination, offset, length)
+
+    monkeypatch.setattr(LocalFileEngine, 'download_range', spy)
+
+    destination = tmp_path / 'backup'
+    with Transfers(retries=0) as transfers:
+        for name in ('r.0.0.mca', 'small.dat'):
+            transfers.put(name, destination / name, (server_home / name).stat())
+
+    assert (destination / 'r.0.0.mca').read_bytes() == data
+    assert (destination / 'small.dat').read_bytes() == b'small'
+    assert sorted(ranges) == [('r.0.0.mca', 0, 30000), ('r.0.0.mca', 30000, 30000), ('r.0.0.mca', 60000, 30000),
+                              ('r.0.0.mca', 90000, 10000)]
+
+    checkouts = []
+    get_host = FileManager.get_host
+    monkeypatch.setattr(FileManager, 'get_host', lambda self: checkouts.append(self) or get_host(self))
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENTS', 2)
+    segmented_download('r.0.0.mca', destination / 'again.mca', (server_home / 'r.0.0.mca').stat())
+    assert (destination / 'again.mca').read_bytes() == data
+    assert len(checkouts) <= 3  # one per connection rather than per piece, plus one to check it hasn't changed
+
+    monkeypatch.setattr(LocalFileEngine, 'download_range', lambda self, host, source, destination, offset, length: 0)
+    with pytest.raises(BackupError, match='Got 0 of the 30000 bytes'):
+        segmented_download('r.0.0.mca', destination / 'again.mca', (server_home / 'r.0.0.mca').stat())
+
+    listed = (server_home / 'r.0.0.mca').stat()
+    (server_home / 'r.0.0.mca').write_bytes(data * 2)  # changed since it was listed
+    with pytest.raises(BackupError, match='r.0.0.mca'):
+        with Transfers(retries=0) as transfers:
+            transfers.put('r.0.0.mca', destination / 'r.0.0.mca', listed)
+
+
+def test_segmented_connection_limit(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    server_home.mkdir()
+    for i in range(3):
+        (server_home / 'r.{}.0.mca'.format(i)).write_bytes(os.urandom(100000))
+        (server_home / 'small{}.dat'.format(i)).write_bytes(b'small')
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENT_THRESHOLD', 1000)
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENT_SIZE', 10000)
+    monkeypatch.setitem(app.config, 'BACKUP_SEGMENTS', 4)
+    monkeypatch.setattr(LocalFileEngine, 'SEGMENTED', True)
+
+    lock = threading.Lock()
+    open_hosts = [0]
+    most_open = [0]
+    get_host = FileManager.get_host
+
+    class Counted:
+        def __init__(self, lease):
+            self.lease = lease
+
+        def __enter__(self):
+            with lock:
+                open_hosts[0] += 1
+                most_open[0] = max(most_open[0], open_hosts[0])
+            return self.lease.__enter__()
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            with lock:
+                open_hosts[0] -= 1
+            return self.lease.__exit__(exc_type, exc_val, exc_tb)
+
+    monkeypatch.setattr(FileManager, 'get_host', lambda self: Counted(get_host(self)))
+
+    download_range = LocalFileEngine.download_range
+
+    def slow_download_range(self, host, source, destination, offset, length):
+        time.sleep(0.01)  # so the pieces overlap
+        return download_range(self, host, source, destination, offset, length)
+
+    monkeypatch.setattr(LocalFileEngine, 'download_range', slow_download_range)
+
+    destination = tmp_path / 'backup'
+    with Transfers(connections=2, retries=0) as transfers:
+        for path in sorted(server_home.iterdir()):
+            transfers.put(path.name, destination / path.name, path.stat())
+
+    assert all((destination / path.name).read_bytes() == path.read_bytes() for path in server_home.iterdir())
+    assert most_open[0] <= 2  # not 2 workers x 4 pieces
+
+
+def test_fast_copier(tmp_path, monkeypatch):
+    source = tmp_path / 'region.mca'
+    source.write_bytes(os.urandom(100000))
+    os.utime(source, (0, 1000000))
+
+    def unsupported(self, src, dst, size):
+        dst.write(b'partial')
+        raise OSError(errno.EOPNOTSUPP, "Not supported")
+
+    copier = FastCopier()
+    monkeypatch.setattr(FastCopier, '_reflink', unsupported)
+    strategy = copier.copy(source, tmp_path / 'copy.mca')
+
+    assert strategy in FastCopier.STRATEGIES and strategy != 'reflink'
+    assert (tmp_path / 'copy.mca').read_bytes() == source.read_bytes()
+    assert (tmp_path / 'copy.mca').stat().st_mtime == 1000000
+
+    for method in ('_copy_file_range', '_sendfile'):
+        monkeypatch.setattr(FastCopier, method, unsupported)
+    assert copier.copy(source, tmp_path / 'copy.mca') == 'copy'
+    assert (tmp_path / 'copy.mca').read_bytes() == source.read_bytes()
+    devices = os.stat(tmp_path).st_dev, os.stat(tmp_path).st_dev
+    assert copier._unsupported[devices] == {'reflink', 'copy_file_range', 'sendfile'}
+
+    def cross_device(self, src, dst, size):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    copier = FastCopier()
+    monkeypatch.setattr(FastCopier, '_reflink', cross_device)
+    assert copier.copy(source, tmp_path / 'copy.mca') == 'copy'
+    assert copier._unsupported[devices] == {'copy_file_range', 'sendfile'}  # reflink's still worth a try next time
+
+
+def test_prune_backups(client, monkeypatch, tmp_path):
+    backups_dir = tmp_path / 'backups'
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_ROTATION', 1)
+    monkeypatch.setitem(app.config, 'BACKUP_DIR_FORMAT', '%Y-%m-%d')
+
+    for day in range(1, 4):
+        for world in ('world', 'world_nether'):
+            region = backups_dir / '2020-01-0{}'.format(day) / world / 'region'
+            region.mkdir(parents=True)
+            (region / 'r.0.0.mca').write_text('region')
+    (backups_dir / TRASH / 'left over' / 'world').mkdir(parents=True)
+
+    trash_backups(outdated_backups(keep=1))
+    assert [item.name for _, item in list_backups()] == ['2020-01-03']
+    assert set(os.listdir(backups_dir / TRASH)) == {'2020-01-01', '2020-01-02', 'left over'}
+
+    (backups_dir / '2020-01-01').mkdir()  # trashing another with the same name doesn't clash
+    trash_backups(outdated_backups(keep=1))
+    assert len(os.listdir(backups_dir / TRASH)) == 4
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(prune_backups, ['--workers', '2'])
+    assert result.exception is None
+    assert 'Removed 4 backups' in result.output
+    assert os.listdir(backups_dir) == ['2020-01-03']
+
+
+@pytest.mark.parametrize('path, is_dir, excluded', [
+    ('world/session.lock', False, True),
+    ('world_nether/session.lock', False, True),
+    ('world/logs', True, True),
+    ('world/logs', False, False),
+    ('world/DIM-1/data/raids.dat', False, True),
+    ('world_nether/DIM-1/data/raids.dat', False, False),
+    ('world/datapacks/huge.zip', False, True),
+    ('world/datapacks/ours.zip', False, False),
+    ('world/region/r.0.0.mca', False, False),
+])
+def test_backup_filter(path, is_dir, excluded):
+    backup_filter = BackupFilter(['# comment', 'session.lock', 'logs/', 'world/DIM*/data/raids.dat', '*.zip',
+                                  '!world/datapacks/ours.zip'])
+    assert backup_filter.excluded(path, is_dir) is excluded
+
+
+def test_backup_exclude(client, monkeypatch, with_engine, tmp_path):
+    server_home = with_engine
+    (server_home / 'basedir' / 'session.lock').write_text('lock')
+    (server_home / 'basedir' / 'level.dat').write_text('level')
+    (server_home / 'basedir' / 'subdir' / 'logs').mkdir()
+    (server_home / 'basedir' / 'subdir' / 'logs' / 'latest.log').write_text('log' * 100)
+    (server_home / 'basedir' / 'subdir' / 'logs' / 'old.log').write_text('log' * 100)
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_EXCLUDE', ['session.lock', 'logs/'])
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(backup, ['--dry-run'])
+    assert result.exception is None
+    assert "Would skip 'basedir/session.lock' - 1 files" in result.output
+    assert "Would skip 'basedir/subdir/logs' - 2 files (0.0 MB)" in result.output
+    assert "Would skip 3 files (0.0 MB), and back up 1 files" in result.output
+    assert os.listdir(backups_dir) == []
+
+    assert runner.invoke(backup, ['--mode', 'full']).exception is None
+    (snapshot,) = backups_dir.iterdir()
+    assert (snapshot / 'basedir' / 'level.dat').exists()
+    assert not (snapshot / 'basedir' / 'session.lock').exists()
+    assert not (snapshot / 'basedir' / 'subdir' / 'logs').exists()
+    assert set(Manifest.load(snapshot).files) == {'basedir/level.dat'}
+
+
+def test_resume_backup(client, monkeypatch, tmp_path):
+    server_home = tmp_path / 'server'
+    (server_home / 'basedir').mkdir(parents=True)
+    for i in range(10):
+        (server_home / 'basedir' / 'file{}.txt'.format(i)).write_text(str(i))
+
+    backups_dir = tmp_path / 'backups'
+    backups_dir.mkdir()
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'LOCAL_SERVER_DIR', server_home)
+    monkeypatch.setitem(app.config, 'BACKUP_DESTINATION', backups_dir)
+    monkeypatch.setitem(app.config, 'BACKUP_SOURCES', ['basedir'])
+    monkeypatch.setitem(app.config, 'BACKUP_RETRIES', 0)
+
+    broken = ['basedir/file7.txt']
+    download = LocalFileEngine.download
+
+    def flaky_download(self, host, source, destination):
+        if source in broken:
+            raise OSError("Connection lost")
+        return download(self, host, source, destination)
+
+    monkeypatch.setattr(LocalFileEngine, 'download', flaky_download)
+
+    runner = app.test_cli_runner()
+    assert isinstance(runner.invoke(backup, ['--mode', 'full']).exception, BackupError)
+
+    assert list_backups() == []  # doesn't count towards the rotation
+    ((_, interrupted),) = list_backups(partial=True)
+    assert not (Path(interrupted.path) / 'basedir' / 'file7.txt').exists()
+
+    broken.clear()
+    result = runner.invoke(backup, ['--mode', 'full', '--resume'])
+    assert result.exception is None
+    assert '1 files (0.0 MB) transferred' in result.output
+    assert '9 already done' in result.output
+
+    assert list_backups(partial=True) == []
+    ((_, resumed),) = list_backups()
+    assert resumed.path == interrupted.path
+    assert (Path(resumed.path) / 'basedir' / 'file7.txt').read_text() == '7'
+    assert (Path(resumed.path) / Progress.COMPLETE).exists()
+    assert len(Manifest.load(resumed.path).files) == 10
+
+    assert runner.invoke(backup, ['--resume']).exception is not None  # nothing left to resume
+
+
+def test_mail_retry(client, monkeypatch):
+    activate(client, good_memb_code, good_member)
+
+    def broken_send(message):
+        raise ConnectionRefusedError("Mail server down")
+
+    monkeypatch.setattr(transport, 'send', broken_send)
+
+    assert Outbox.send_pending() == (0, 1)
+
+    entry = Outbox.query.one()
+    assert entry.attempts == 1
+    assert 'Mail server down' in entry.last_error
+    assert Outbox.send_pending() == (0, 0)  # backing off
+
+    monkeypatch.undo()
+    entry.next_attempt = datetime.datetime.utcnow()
+    db.session.commit()
+
+    with mail.record_messages() as outbox:
+        assert Outbox.send_pending() == (1, 0)
+
+    assert len(outbox) == 1
+    assert len(Outbox.query.all()) == 0
+
+
+def test_mail_bad_entry(client):
+    with pytest.raises(ValueError):
+        Outbox.queue(make_email('victim@email.com\nBcc: everyone@email.com', 'Subject', 'text'))
+
+    assert 'Invalid email address' in register(client, good_memb_code, 'Test@email.com\r\nBcc: x@email.com', good_mc_user)
+    assert Outbox.query.all() == []
+
+    db.session.add(Outbox(recipient='bad\n@email.com', subject='Stuck', body='text'))  # e.g. queued by an older version
+    Outbox.queue(make_email(good_email, 'Fine', 'text'))
+    db.session.commit()
+
+    with mail.record_messages() as outbox:
+        assert Outbox.send_pending() == (1, 1)
+
+    assert [message.subject for message in outbox] == ['Fine']
+    entry = Outbox.query.one()
+    assert entry.attempts == 1
+    assert 'BadHeaderError' in entry.last_error
+    assert entry.claimed_at is None
+
+
+def test_mail_claim(client, monkeypatch):
+    Outbox.queue(make_email(good_email, 'First', 'text'))
+    Outbox.queue(make_email(good_email, 'Second', 'text'))
+    db.session.commit()
+
+    first, second = Outbox.pending(10)
+    assert first.claim()  # another worker is part way through sending this one
+    assert not first.claim()
+
+    with mail.record_messages() as outbox:
+        assert Outbox.send_pending() == (1, 0)
+    assert [message.subject for message in outbox] == ['Second']
+
+    monkeypatch.setitem(app.config, 'MAIL_CLAIM_TIMEOUT', -1)  # the other worker died
+    with mail.record_messages() as outbox:
+        assert Outbox.send_pending() == (1, 0)
+    assert [message.subject for message in outbox] == ['First']
+
+
+def test_mail_transport(client):
+    transport.close_all()
+
+    with mail.record_messages() as outbox:
+        transport.send(make_email(good_email, 'First', 'text'))
+        connection = transport._idle[0][0]
+        transport.send(make_email(good_email, 'Second', 'text'))
+
+    assert [message.subject for message in outbox] == ['First', 'Second']
+    assert transport._idle == [(connection, transport._idle[0][1])]  # same connection reused
+
+
+def test_mail_transport_reconnect(client, monkeypatch):
+    transport.close_all()
+    transport.send(make_email(good_email, 'First', 'text'))
+    (dropped, _), = transport._idle
+
+    def disconnected(message):
+        raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+    def refused():
+        raise smtplib.SMTPAuthenticationError(535, b"Authentication failed")
+
+    monkeypatch.setattr(dropped, 'send', disconnected, raising=False)
+    monkeypatch.setattr(transport, '_connect', refused)
+
+    with pytest.raises(smtplib.SMTPAuthenticationError):
+        transport.send(make_email(good_email, 'Second', 'text'))
+    assert transport._idle == []  # the dropped connection isn't put back
+
+
+def test_profile_cache(client, monkeypatch, tmp_path):
+    profile_cache.clear()
+    monkeypatch.setitem(app.config, 'MOJANG_CACHE_SIZE', 2)
+
+    profile_cache.set('Known', 'a62b155cde184c2ca993fa68b987901d')
+    profile_cache.set('Unknown', None)
+
+    assert profile_cache.get('known') == (True, 'a62b155cde184c2ca993fa68b987901d')
+    assert profile_cache.get('unknown') == (True, None)
+    assert profile_cache.get('Other') == (False, None)
+
+    profile_cache.set('Other', None)
+    assert profile_cache.get('Known') == (False, None)  # evicted
+
+    monkeypatch.setitem(app.config, 'MOJANG_NEGATIVE_CACHE_TTL', -1)
+    profile_cache.set('Expired', None)
+    assert profile_cache.get('Expired') == (False, None)
+
+    monkeypatch.setitem(app.config, 'MOJANG_CACHE_FILE', (tmp_path / 'mojang.db').as_posix())
+    profile_cache.set('Persisted', 'a62b155cde184c2ca993fa68b987901d')
+    profile_cache.clear()
+    assert profile_cache.get('Persisted') == (True, 'a62b155cde184c2ca993fa68b987901d')
+
+
+def test_mojang_client(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MOJANG_API_URL', 'http://127.0.0.1:8765')
+    monkeypatch.setitem(app.config, 'MOJANG_RETRIES', 0)
+    monkeypatch.setitem(app.config, 'MOJANG_BREAKER_THRESHOLD', 2)
+
+    mojang = MojangClient()
+    mj_id = test_mj_resp[0]['uuid'].replace('-', '')
+    server = TestMojangServer('127.0.0.1', 8765, {good_mc_user: mj_id})
+
+    with server:
+        assert mojang.get_id(good_mc_user.upper()) == mj_id
+        assert mojang.get_id(bad_mc_user) is None
+
+        server.status = 503
+
+        for _ in range(2):
+            with pytest.raises(MojangUnavailable, match='503'):
+                mojang.get_id(good_mc_user)
+
+        n_requests = len(server.requests)
+
+        with pytest.raises(MojangUnavailable, match='circuit open'):
+            mojang.get_id(good_mc_user)
+
+        assert len(server.requests) == n_requests  # failed fast
+
+        monkeypatch.setattr(membership, 'mojang', mojang)
+        profile_cache.clear()
+        activate(client, good_memb_code, good_member)
+        user = Member.query.get(good_member)
+
+        resp = register(client, user.sponsor_code, good_email, good_mc_user)
+        assert resp == render_template("message.html", bad=Messages.MOJANG_UNAVAILABLE)
+        assert len(server.requests) == n_requests
+
+        monkeypatch.setitem(app.config, 'MOJANG_BREAKER_RESET', 0)
+        server.status = 200
+
+        assert mojang.get_id(good_mc_user) == mj_id  # trial request closes the circuit
+        assert mojang.get_id(good_mc_user) == mj_id
+
+
+def test_mojang_batches(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MOJANG_API_URL', 'http://127.0.0.1:8765')
+    monkeypatch.setitem(app.config, 'MOJANG_BATCH_INTERVAL', 0)
+    monkeypatch.setattr(membership, 'mojang', MojangClient())
+    profile_cache.clear()
+
+    profiles = {'Player{}'.format(i): '{:032x}'.format(i) for i in range(20)}
+    usernames = list(profiles) + [bad_mc_user + str(i) for i in range(5)]
+
+    server = TestMojangServer('127.0.0.1', 8765, profiles)
+
+    with server:
+        ids = get_mj_ids(usernames + ['player0'])
+
+        assert [len(batch) for batch in server.requests] == [10, 10]  # too long to be usernames, so never sent
+        assert ids == dict(profiles, player0=profiles['Player0'], **{name: None for name in usernames[20:]})
+
+        assert get_mj_ids(usernames) == {name: ids[name] for name in usernames}
+        assert len(server.requests) == 2  # all cached
+
+
+def test_mojang_errors(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MOJANG_API_URL', 'http://127.0.0.1:8765')
+    monkeypatch.setitem(app.config, 'MOJANG_BATCH_INTERVAL', 0)
+    monkeypatch.setitem(app.config, 'MOJANG_RETRIES', 0)
+    monkeypatch.setattr(membership, 'mojang', MojangClient())
+    profile_cache.clear()
+
+    server = TestMojangServer('127.0.0.1', 8765, {'Player0': '{:032x}'.format(0)})
+
+    with server:
+        server.status = 404
+        with pytest.raises(MojangUnavailable, match='404'):
+            get_mj_ids(['Player0', 'Missing'])
+        assert profile_cache.get('Missing') == (False, None)  # not taken to mean it doesn't exist
+
+        server.status = 200
+        server.rejected = {'Rejected'}
+        server.requests.clear()
+        assert get_mj_ids(['Player0', 'Rejected', 'Missing']) == {'Player0': '{:032x}'.format(0), 'Missing': None}
+        assert server.requests == [['Player0', 'Rejected', 'Missing'], ['Player0'], ['Rejected'], ['Missing']]
+        assert profile_cache.get('Missing') == (True, None)
+        assert profile_cache.get('Rejected') == (False, None)
+
+        with pytest.raises(MojangUnavailable, match='rejected'):
+            membership.mojang.get_id('Rejected')
+
+
+def test_refresh_profiles(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MOJANG_API_URL', 'http://127.0.0.1:8765')
+    monkeypatch.setitem(app.config, 'MOJANG_SESSION_URL', 'http://127.0.0.1:8765')
+    monkeypatch.setitem(app.config, 'MOJANG_BATCH_INTERVAL', 0)
+    monkeypatch.setattr(membership, 'mojang', MojangClient())
+
+    synced = []
+    monkeypatch.setattr(site, 'sync_whitelist', synced.append)
+
+    member = Member(id=good_member)
+    db.session.add(member)
+    for i in range(25):
+        db.session.add(Whitelist(username='Player{}'.format(i), id='{:032x}'.format(i), email=good_email,
+                                 sponsor=member))
+    db.session.commit()
+
+    profiles = {'Player{}'.format(i): '{:032x}'.format(i) for i in range(25)}
+    profiles['Renamed'] = profiles.pop('Player3')
+
+    with TestMojangServer('127.0.0.1', 8765, profiles):
+        result = app.test_cli_runner().invoke(refresh_profiles, ['--page-size', '10'])
+
+    assert result.exception is None
+    assert "'Player3' is now 'Renamed'" in result.output
+    assert "Checked 25 entries" in result.output
+    assert Whitelist.query.get('Renamed').id == '{:032x}'.format(3)
+    assert Whitelist.query.get('Player3') is None
+    assert synced == [Whitelist]
+
+
+@pytest.mark.parametrize('use_db', [False, True])
+def test_member_index(tmp_path, use_db):
+    members_file = tmp_path / 'members.csv'
+    members_file.write_text('one\ntwo\r\n\n')
+
+    index = MemberIndex(members_file.as_posix(), (tmp_path / 'members.db').as_posix() if use_db else None)
+
+    assert 'one' in index
+    assert 'two' in index
+    assert 'three' not in index
+    assert index.count == 2
+    assert index.load_time is not None
+
+    members_file.write_text('two\nthree\n')
+    os.utime(members_file, ns=(0, members_file.stat().st_mtime_ns + 10 ** 9))
+
+    assert 'one' not in index
+    assert 'three' in index
+    assert index.count == 2
+
+
+def test_quotas(client):
+    activate(client, good_memb_code, good_member)
+    member = Member.query.get(good_member)
+
+    for i in range(app.config['QUOTA']):
+        db.session.add(Whitelist(username='Player{}'.format(i), id='{:032x}'.format(i), email=good_email,
+                                 sponsor=member))
+    db.session.commit()
+
+    assert Member.query.get(good_member).quota == 0
+    assert register(client, member.sponsor_code, good_email, good_mc_user) == \
+        render_template("message.html", bad=Messages.OUTTA_GUESTS)
+
+    db.session.delete(Whitelist.query.get('Player0'))
+    db.session.commit()
+    assert Member.query.get(good_member).quota == 1
+
+    runner = app.test_cli_runner()
+    assert 'All guest counts correct' in runner.invoke(check_quotas).output
+
+    Whitelist.query.filter_by(username='Player1').delete()  # bulk delete skips counting
+    db.session.commit()
+
+    result = runner.invoke(check_quotas, ['--fix'])
+    assert "Member '{}' has 2 guests, but is counted as having 3".format(good_member) in result.output
+    assert Member.query.get(good_member).quota == 2
+    assert 'All guest counts correct' in runner.invoke(check_quotas).output
+
+
+def make_old_database():
+    """
+    Replace the database with one made by MinerClub before migrations were added.
+    """
+    db.drop_all()
+    db.session.execute("PRAGMA user_version = 0")
+    db.session.execute("CREATE TABLE member (id VARCHAR PRIMARY KEY, sponsor_code VARCHAR, email VARCHAR)")
+    db.session.execute("CREATE TABLE whitelist (username VARCHAR PRIMARY KEY, id VARCHAR NOT NULL, "
+                       "email VARCHAR NOT NULL, member_id INTEGER NOT NULL REFERENCES member (id))")
+    db.session.execute("INSERT INTO member VALUES ('123', 'code', 'email')")
+    db.session.execute("INSERT INTO whitelist VALUES ('Player', 'a62b155cde184c2ca993fa68b987901d', 'email', '123')")
+    db.session.commit()
+
+
+def test_migrate(client):
+    make_old_database()
+
+    result = app.test_cli_runner().invoke(migrate)
+    assert result.exception is None
+    assert 'Applied index_sponsors' in result.output
+
+    member = Member.query.get('123')
+    assert member.guest_count == 1
+    assert member.users[0].member_id == '123'
+    assert Outbox.query.all() == []
+
+    indexes = {index['name'] for index in db.inspect(db.engine).get_indexes('whitelist')}
+    assert 'ix_whitelist_member_id' in indexes
+
+    assert migrations.upgrade() == []
+
+
+def test_init_old_database(client):
+    make_old_database()
+
+    result = app.test_cli_runner().invoke(init_db)
+    assert result.exception is None
+    assert 'Applied add_guest_count' in result.output
+
+    assert Member.query.get('123').guest_count == 1
+    assert migrations.upgrade() == []
+
+
+def test_migrate_outbox_claims(client):
+    db.session.execute("DROP TABLE outbox")
+    db.session.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY, recipient VARCHAR NOT NULL, "
+                       "subject VARCHAR NOT NULL, body TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                       "next_attempt DATETIME NOT NULL, last_error VARCHAR)")
+    db.session.execute("PRAGMA user_version = 2")
+    db.session.commit()
+
+    assert migrations.upgrade() == ['add_outbox_claims']
+
+    Outbox.queue(make_email(good_email, 'Subject', 'text'))
+    db.session.commit()
+    assert Outbox.send_pending() == (1, 0)
+
+
+def test_failed_migration(client, monkeypatch):
+    make_old_database()
+
+    def interrupted(connection):
+        migrations.index_sponsors(connection)
+        raise RuntimeError("Interrupted")
+
+    monkeypatch.setattr(migrations, 'migrations', [migrations.add_guest_count, interrupted])
+    with pytest.raises(RuntimeError):
+        migrations.upgrade()
+
+    assert db.session.execute("PRAGMA user_version").scalar() == 1  # add_guest_count was kept
+    assert db.session.execute("SELECT member_id FROM whitelist").fetchall() == [(123,)]  # still the old table
+
+    monkeypatch.undo()
+    assert migrations.upgrade() == ['index_sponsors', 'add_outbox_claims']
+    assert Member.query.get('123').users[0].member_id == '123'
+
+
+def test_whitelist_sync(client, monkeypatch):
+    synced = []
+    monkeypatch.setattr(server_comms, 'update_whitelist', lambda whitelist, **kwargs: synced.append(whitelist))
+    monkeypatch.setitem(app.config, 'WHITELIST_SYNC_DELAY', 0.5)
+
+    sync = WhitelistSync()
+    for _ in range(5):
+        sync.schedule(Whitelist)
+
+    assert synced == []
+    time.sleep(1)
+    assert synced == [Whitelist]
+
+    sync.schedule(Whitelist)
+    sync.flush()
+    assert synced == [Whitelist, Whitelist]
+
+    time.sleep(1)
+    assert synced == [Whitelist, Whitelist]  # nothing left for the background thread to do
+
+
+def test_sync_unchanged(client, with_engine, monkeypatch):
+    state = Path(app.config['WHITELIST_SYNC_STATE'])
+    if state.exists():
+        state.unlink()
+
+    assert update_whitelist(Whitelist) == 'uploaded'
+    assert update_whitelist(Whitelist) == 'unchanged'
+
+    with file_manager.get_host() as host:
+        file_manager.write_text(host, file_manager.whitelist, '{}')  # same size, different contents
+
+    with monkeypatch.context() as m:
+        m.setattr(file_manager, 'get_host', lambda: pytest.fail("Connected without anything to check"))
+        assert update_whitelist(Whitelist, verify='none') == 'unchanged'
+    assert update_whitelist(Whitelist) == 'drift detected'  # small enough to read back
+    assert update_whitelist(Whitelist, verify='hash') == 'unchanged'
+
+    with file_manager.get_host() as host:
+        file_manager.write_text(host, file_manager.whitelist, '{}')
+
+    with monkeypatch.context() as m:
+        m.setattr(server_comms, 'READ_BACK_LIMIT', 0)
+        assert update_whitelist(Whitelist) == 'unchanged'  # only the size is checked
+        assert update_whitelist(Whitelist, verify='hash') == 'drift detected'
+
+    with file_manager.get_host() as host:
+        file_manager.write_text(host, file_manager.whitelist, '[ ]')
+
+    assert update_whitelist(Whitelist) == 'drift detected'
+    assert update_whitelist(Whitelist, force=True) == 'uploaded'
+
+    with file_manager.get_host() as host:
+        assert json.loads(file_manager.read_text(host, file_manager.whitelist)) == []
+
+
+def test_sync_targets(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'FILE_ENGINE', 'LOCAL')
+    monkeypatch.setitem(app.config, 'SYNC_TARGETS', ['CREATIVE', 'SLOW'])
+    for target in ('MAIN', 'CREATIVE', 'SLOW'):
+        prefix = '' if target == 'MAIN' else target + '_'
+        (tmp_path / target / 'basedir').mkdir(parents=True)
+        monkeypatch.setitem(app.config, prefix + 'FILE_ENGINE', 'LOCAL')
+        monkeypatch.setitem(app.config, prefix + 'LOCAL_SERVER_DIR', tmp_path / target)
+        monkeypatch.setitem(app.config, prefix + 'LOCAL_WHITELIST_PATH', 'basedir/whitelist.json')
+        monkeypatch.setitem(app.config, prefix + 'SYNC_TIMEOUT', 5)
+    monkeypatch.setitem(app.config, 'SLOW_SYNC_TIMEOUT', 0.5)
+
+    write_chunks = LocalFileEngine.write_chunks
+
+    def slow_write_chunks(self, host, path, chunks):
+        if self.prefix == 'SLOW_':
+            time.sleep(2)
+        return write_chunks(self, host, path, chunks)
+
+    monkeypatch.setattr(LocalFileEngine, 'write_chunks', slow_write_chunks)
+
+    start = time.monotonic()
+    results = update_targets(Whitelist, force=True)
+    assert time.monotonic() - start < 1.5  # not held up by the slow target
+
+    assert results == {'main': 'uploaded', 'CREATIVE': 'uploaded', 'SLOW': 'timed out'}
+    slow, = [thread for thread in threading.enumerate() if thread.name == 'whitelist-target-SLOW']
+    assert slow.daemon  # won't hold up the interpreter exiting
+    assert json.loads((tmp_path / 'MAIN' / 'basedir' / 'whitelist.json').read_text()) == []
+    assert json.loads((tmp_path / 'CREATIVE' / 'basedir' / 'whitelist.json').read_text()) == []
+
+    monkeypatch.setitem(app.config, 'SYNC_TARGETS', [])
+    assert update_targets(Whitelist) == {'main': 'unchanged'}
+
+
+def test_host_pool(with_engine, monkeypatch):
+    with app.app_context():
+        file_manager.close_all()
+
+        with file_manager.get_host() as host:
+            file_manager.write_text(host, 'basedir/test.txt', 'pooled')
+
+        with file_manager.get_host() as reused:
+            assert reused is host
+            assert file_manager.read_text(reused, 'basedir/test.txt') == 'pooled'
+
+        monkeypatch.setitem(app.config, 'FILE_POOL_HEALTH_CHECK', -1)  # always check
+
+        with file_manager.get_host() as checked:
+            assert checked is host
+
+        with pytest.raises(RuntimeError):
+            with file_manager.get_host() as broken:
+                raise RuntimeError("Something went wrong")
+
+        with file_manager.get_host() as fresh:
+            assert fresh is not broken or file_manager.engine_name == 'LOCAL'
+
+
+def test_whitelist_json(client):
+    member = Member(id=good_member)
+    db.session.add(member)
+    for i in range(25):
+        db.session.add(Whitelist(username='Player{}'.format(i), id='{:032x}'.format(i), email=good_email,
+                                 sponsor=member))
+    db.session.commit()
+
+    chunks = list(Whitelist.iter_json(chunk_size=10))
+
+    assert len(chunks) == 5  # brackets + 3 chunks of entries
+    assert json.loads(''.join(chunks)) == Whitelist.serialise()
+    assert Whitelist.serialise()[1] == {'uuid': '00000000-0000-0000-0000-000000000001', 'name': 'Player1'}
+    assert Whitelist.query.get('Player1').to_dict() == Whitelist.serialise()[1]
+
+
+def test_rcon(client, monkeypatch):
+    synced = []
+    monkeypatch.setattr(server_comms, 'update_whitelist', lambda whitelist, **kwargs: synced.append(whitelist))
+    monkeypatch.setitem(app.config, 'RCON_ENABLED', True)
+
+    member = Member(id=good_member)
+    db.session.add(member)
+    db.session.add(Whitelist(username='Player1', id='{:032x}'.format(1), email=good_email, sponsor=member))
+    db.session.commit()
+
+    server = TestRconServer(app.config['RCON_ADDRESS'], app.config['RCON_PORT'], app.config['RCON_PASSWORD'])
+
+    with server:
+        assert sync_whitelist(Whitelist, added=['Player2']) == 'sent 1 changes over RCON'
+        assert server.whitelist == {'Player2'}
+
+        server.whitelist.add('Removed')
+        assert sync_whitelist(Whitelist) == 'sent 3 changes over RCON'
+        assert server.whitelist == {'Player1'}
+
+        assert sync_whitelist(Whitelist, added=['Player1']) == 'sent 1 changes over RCON'  # already there
+
+        sync_whitelist(Whitelist, added=['Bad; op me'])
+        assert synced == [Whitelist]
+
+        server.missing.add('Ghost')
+        sync_whitelist(Whitelist, added=['Ghost', 'Player4'])
+        assert synced == [Whitelist, Whitelist]  # not applied, so uploaded instead
+        assert 'Player4' in server.whitelist
+
+        monkeypatch.setitem(app.config, 'RCON_PASSWORD', 'Wrong password')
+        sync_whitelist(Whitelist, added=['Player3'])
+        assert synced == [Whitelist, Whitelist, Whitelist]
+        assert 'whitelist add Player3' not in server.commands
+
+    monkeypatch.setitem(app.config, 'RCON_PASSWORD', TestingConfig.RCON_PASSWORD)
+    sync_whitelist(Whitelist, added=['Player3'])  # server's down
+    assert synced == [Whitelist, Whitelist, Whitelist, Whitelist]
+
+
+def test_rcon_responses(client, monkeypatch):
+    c = app.config
+    server = TestRconServer(c['RCON_ADDRESS'], c['RCON_PORT'], c['RCON_PASSWORD'])
+    monkeypatch.setattr(server, 'run_command', lambda command: 'x' * int(command))
+
+    with server, RconClient(c['RCON_ADDRESS'], c['RCON_PORT'], c['RCON_PASSWORD'], c['RCON_TIMEOUT']) as rcon:
+        start = time.monotonic()
+        assert rcon.command('4096') == 'x' * 4096  # exactly one full fragment
+        assert rcon.command('5000') == 'x' * 5000
+        assert rcon.command('0') == ''
+        assert time.monotonic() - start < c['RCON_TIMEOUT']
+
+    for name in ('Jos\u00e9', 'Player\n', 'a' * 17, ''):
+        with pytest.raises(RconError):
+            rcon_update([name], [])
+
+
+def test_rcon_sync_targets(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'RCON_ENABLED', True)
+    monkeypatch.setitem(app.config, 'SYNC_TARGETS', ['CREATIVE'])
+    for target in ('MAIN', 'CREATIVE'):
+        prefix = '' if target == 'MAIN' else target + '_'
+        (tmp_path / target / 'basedir').mkdir(parents=True)
+        monkeypatch.setitem(app.config, prefix + 'FILE_ENGINE', 'LOCAL')
+        monkeypatch.setitem(app.config, prefix + 'LOCAL_SERVER_DIR', tmp_path / target)
+        monkeypatch.setitem(app.config, prefix + 'LOCAL_WHITELIST_PATH', 'basedir/whitelist.json')
+        monkeypatch.setitem(app.config, prefix + 'SYNC_TIMEOUT', 5)
+
+    main = tmp_path / 'MAIN' / 'basedir' / 'whitelist.json'
+    creative = tmp_path / 'CREATIVE' / 'basedir' / 'whitelist.json'
+
+    member = Member(id=good_member)
+    db.session.add(member)
+    db.session.add(Whitelist(username='Player1', id='{:032x}'.format(1), email=good_email, sponsor=member))
+    db.session.commit()
+
+    server = TestRconServer(app.config['RCON_ADDRESS'], app.config['RCON_PORT'], app.config['RCON_PASSWORD'])
+
+    with server:
+        status = sync_whitelist(Whitelist, added=['Player1'])
+        assert status == 'main: sent 1 changes over RCON, CREATIVE: uploaded'
+        assert server.whitelist == {'Player1'}
+
+    assert not main.exists()  # kept up to date over RCON instead
+    assert json.loads(creative.read_text())[0]['name'] == 'Player1'
+
+    assert sync_whitelist(Whitelist) == 'main: uploaded, CREATIVE: unchanged'  # RCON's down
+    assert json.loads(main.read_text())[0]['name'] == 'Player1'